@@ -0,0 +1,158 @@
+# Micro-benchmark of parse_js_file_content against the previous per-line
+# regex implementation (kept below, without the jsx post processing which is
+# unchanged).
+#
+# Run from the repo root: python -m benchmarks.parse_js_file_content [repeat]
+
+import re
+import sys
+import timeit
+from internal.parse_js_file_content import parse_js_file_content
+
+SAMPLE = """
+import React, { useState, useEffect } from "react";
+import { api } from "../lib/api"; // http client
+
+/**
+ * Renders the list of the user's repositories,
+ * fetched on mount.
+ */
+export default function RepoList({ username }) {
+    const [repos, setRepos] = useState([]);
+    const url = "https://api.github.com/users/" + username; // not a comment
+
+    useEffect(() => {
+        api.get(url).then((res) => setRepos(res.data));
+    }, [url]);
+
+    return <ul>{repos.map((r) => <li key={r.id}>{r.name}</li>)}</ul>;
+}
+
+const useRepos = () => {
+    var cache = {};
+    return cache;
+};
+
+class RepoStore extends Store {}
+interface RepoProps { name: string }
+type RepoId = number;
+/* single line block comment */
+"""
+
+
+def legacy_parse_js_file_content(fname: str, content: str):
+    information = {
+        "comments": [],
+        "functions": [],
+        "classes": [],
+        "arrow_functions": [],
+        "global_variables": [],
+        "struct_types": [],
+        "constants": [],
+        "type_definitions": [],
+        "components": [],
+        "hooks": [],
+    }
+
+    is_jsx = fname.endswith((".tsx", ".jsx"))
+
+    lines = content.splitlines()
+    for line_number, line in enumerate(lines, start=1):
+        # Extract Comments
+        comments_match = re.findall(r"\/\/(.+)|\/\*(.+)\*\/", line)
+        if comments_match:
+            information["comments"].extend(
+                [
+                    {"name": c[0] if c[0] else c[1], "line_number": line_number}
+                    for c in comments_match
+                ]
+            )
+
+        # Extract Functions
+        functions_match = re.findall(r"\bfunction\s+([a-zA-Z_$][\w$]*)\s*\(", line)
+        information["functions"].extend(
+            [{"name": func, "line_number": line_number} for func in functions_match]
+        )
+
+        # Extract Classes
+        classes_match = re.findall(r"\bclass\s+([a-zA-Z_$][\w$]*)", line)
+        information["classes"].extend(
+            [{"name": class_, "line_number": line_number} for class_ in classes_match]
+        )
+
+        # Extract Arrow Functions
+        arrow_functions_match = re.findall(r"([a-zA-Z_$][\w$]*)\s*=\s*\(\)\s*=>", line)
+        information["arrow_functions"].extend(
+            [
+                {"name": func, "line_number": line_number}
+                for func in arrow_functions_match
+            ]
+        )
+
+        # Extract Global Variables
+        global_variables_match = re.findall(r"\bvar\s+([a-zA-Z_$][\w$]*)\s*=", line)
+        information["global_variables"].extend(
+            [
+                {"name": var, "line_number": line_number}
+                for var in global_variables_match
+            ]
+        )
+
+        # Extract Struct Types (Assuming struct is defined similar to a class)
+        struct_types_match = re.findall(r"\bstruct\s+([a-zA-Z_$][\w$]*)", line)
+        information["struct_types"].extend(
+            [
+                {"name": struct, "line_number": line_number}
+                for struct in struct_types_match
+            ]
+        )
+
+        # Extract Constants
+        constants_match = re.findall(r"\bconst\s+([a-zA-Z_$][\w$]*)\s*=", line)
+        information["constants"].extend(
+            [{"name": const, "line_number": line_number} for const in constants_match]
+        )
+
+        # Extract Type Definitions
+        type_definitions_match = re.findall(
+            r"\b(?:type|interface)\s+([a-zA-Z_$][\w$]*)", line
+        )
+        information["type_definitions"].extend(
+            [
+                {"name": type_def, "line_number": line_number}
+                for type_def in type_definitions_match
+            ]
+        )
+
+        # Extract Components for TSX and JSX files
+        if is_jsx:
+            components_match = re.findall(
+                r"\b(?:export\s+default\s+(?:async\s+)?+(?:function|const|class)\s+([A-Z_$][\w$]*))",
+                line,
+            )
+
+            information["components"].extend(
+                [
+                    {"name": component, "line_number": line_number}
+                    for component in components_match
+                ]
+            )
+    return information
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    # a large, bundle like file
+    content = SAMPLE * 500
+    fname = "RepoList.tsx"
+
+    for name, fn in (
+        ("legacy per-line regexes", legacy_parse_js_file_content),
+        ("single-pass tokenizer", parse_js_file_content),
+    ):
+        secs = min(timeit.repeat(lambda: fn(fname, content), number=1, repeat=repeat))
+        print(f"{name:<26} {secs * 1000:8.2f} ms / {len(content) // 1024} KiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+import os
+
+# gunicorn settings, read by default from ./gunicorn.conf.py
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+
+# "sync" serves one request at a time per worker. "gevent" serves up to
+# GUNICORN_WORKER_CONNECTIONS at a time per worker, its monkey patching makes
+# the network calls (github, openai) and the sleeps cooperative, so a worker
+# waiting on them serves the other requests meanwhile
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "500"))
@@ -1,11 +1,112 @@
-import internal.utils as utils
+import internal.cache as cache
 import internal.fetch_stats as gstats
 import internal.fetch_files as gfiles
-from internal.parse_js_file_content import parse_js_file_content, convert_to_plain_text
+import internal.fetch_contents as gcontents
+from internal.parse_js_file_content import render_file
+import internal.parse_pool as parse_pool
 import internal.openapi as openapi
+import internal.prompt as prompt_builder
+import internal.repo_index as repo_index
+import internal.singleflight as singleflight
+import internal.utils as utils
+import hashlib
+import itertools
+import queue
+import threading
+import io
+import os
+
+# maximum number of files of a repo to be analysed
+MAX_FILES = 100
+
+# files loaded past the ones needed, to make up for the ones failing to load
+LOAD_SLACK = 8
+
+# files larger than this are skipped, mostly generated or bundled code, and
+# the total bytes of the files selected for downloading in a repo
+MAX_FILE_BYTES = int(os.getenv("MAX_FILE_BYTES", str(100 * 1024)))
+MAX_TOTAL_BYTES = int(os.getenv("MAX_TOTAL_BYTES", str(1536 * 1024)))
+
+# skip the test files too
+SKIP_TEST_FILES = os.getenv("SKIP_TEST_FILES", "") not in ("", "0", "false")
+
+# minified and bundled files, and the test files' directories and markers,
+# the vendored directories are in gfiles.SKIP_DIRS
+SKIP_SUFFIXES = (".min.js", ".bundle.js", ".chunk.js")
+TEST_DIRS = {"test", "tests", "__tests__", "__mocks__", "e2e"}
+TEST_MARKERS = (".test.", ".spec.")
+
+# part of the parsed files' cache keys, bump it when the parser output changes
+PARSER_VERSION = "v1"
+
+# part of the repo digests' cache keys, bump it when the rendering changes
+DIGEST_VERSION = "v1"
+
+# fields of the analysis result per view, besides its statusCode, the
+# default view is "debug", having all of them
+ANALYSIS_VIEWS = {
+    "summary": {
+        "analysisedRepo",
+        "inputQuery",
+        "answeredBy",
+        "gpt3.5prediction",
+        "promptTokens",
+    },
+}
+ANALYSIS_VIEWS["full"] = ANALYSIS_VIEWS["summary"] | {"userStats"}
+ANALYSIS_VIEWS["debug"] = ANALYSIS_VIEWS["full"] | {"zparsedFiles", "prompt", "prompt2"}
+
+# fields needing the repo's digest, and the answer to the query
+DIGEST_FIELDS = {"zparsedFiles", "prompt", "prompt2", "promptTokens"}
+ANSWER_FIELDS = {"answeredBy", "gpt3.5prediction"}
+
+
+# analyse_user, concurrent analyses of the same user, query and fields are shared
+def analyse_user(username: str, query: str, nocache=False, fields=None):
+    return singleflight.do(
+        f"analyse/{username.lower()}/{nocache}/{sorted(fields or [])}/{query}",
+        lambda: run_analysis(username, query, nocache, fields=fields),
+    )
+
+
+# Streams the analysis as (event, data) tuples, while it runs: its progress
+# (stats, repo, file, digest), the llm answer's tokens as they arrive (token)
+# and finally the result of the "full" view (done), or the error (error)
+def stream_analysis(username: str, query: str, nocache=False):
+    events = queue.Queue()
+
+    def run():
+        try:
+            resp = run_analysis(
+                username,
+                query,
+                nocache,
+                fields=ANALYSIS_VIEWS["full"],
+                progress=progress,
+            )
+        except Exception as err:
+            print("exception something went wrong in analyse stream:", err)
+            resp = {"statusCode": 500, "error": "500: Internal Server Error"}
+        events.put(("error" if "error" in resp else "done", resp))
+
+    def progress(event: str, data: dict):
+        events.put((event, data))
 
+    threading.Thread(target=run, daemon=True).start()
+    while True:
+        event, data = events.get()
+        yield event, data
+        if event in ("done", "error"):
+            return
+
+
+# Runs the analysis, building only the result's fields asked for (all of them
+# by default), progress is called with (event, data) as it advances, if given
+def run_analysis(username: str, query: str, nocache=False, fields=None, progress=None):
+    report = progress or (lambda event, data: None)
+    if fields is None:
+        fields = ANALYSIS_VIEWS["debug"]
 
-def analyse_user(username: str, query: str, nocache=False):
     # fetch user's stats
     userStats = gstats.fetch_user_data(username, nocache)
     if userStats is None:
@@ -17,66 +118,99 @@ def analyse_user(username: str, query: str, nocache=False):
         return userStats
 
     userStats = userStats["data"]
+    report("stats", {"username": username})
     topRepos = userStats.get("topRepositories", [])
     jsrepo = gfiles.find_js_repo(topRepos)
     if jsrepo is None:
-        return {
-            "statusCode": 404,
-            "error": "no js or ts repo found in topRepos",
-            "userStats": userStats,
-        }
+        resp = {"statusCode": 404, "error": "no js or ts repo found in topRepos"}
+        if "userStats" in fields:
+            resp["userStats"] = userStats
+        return resp
 
     repoWithOwner = str(jsrepo.get("nameWithOwner", ""))
     repoOwner = repoWithOwner.split("/")[0]
     repoName = repoWithOwner.split("/")[1]
-    files = gfiles.fetch_repo_files(
+    tree = gfiles.fetch_repo_tree(
         repoOwner,  # owner's username
         repoName,  # repo name
         nocache,
     )
-    if "error" in files:
-        return files  # error
+    if "error" in tree:
+        return tree  # error
 
+    files = tree["files"]
+    report("repo", {"analysisedRepo": repoWithOwner})
     if len(files) == 0:
-        return {
-            "statusCode": 412,
-            "analysisedRepo": repoWithOwner,
-            "message": "no files found in it",
-            "userStats": userStats,
-        }
+        resp = {"statusCode": 412}
+        if "analysisedRepo" in fields:
+            resp["analysisedRepo"] = repoWithOwner
+        resp["message"] = "no files found in it"
+        if "userStats" in fields:
+            resp["userStats"] = userStats
+        return resp
+
+    resp = {"statusCode": 200}
+    if "analysisedRepo" in fields:
+        resp["analysisedRepo"] = repoWithOwner
+    if "inputQuery" in fields:
+        resp["inputQuery"] = query
+    if "userStats" in fields:
+        resp["userStats"] = userStats
+    if not fields & (DIGEST_FIELDS | ANSWER_FIELDS):
+        return resp
 
     # now, convert all files into corresponding segments and create a plain text representation out of it
-    plainTextRepoDetails, parsedFiles = process_repo_files_to_plain_text(
+    plainTextRepoDetails, parsedFiles = repo_digest(
         repoOwner,
         repoName,
-        files,
+        tree,
         nocache,
+        progress=report,
     )
+    if "zparsedFiles" in fields:
+        resp["zparsedFiles"] = parsedFiles
 
-    prompt = (
-        f"For Repo - {repoWithOwner}, these are the extracted details of the files in the repo: \n"
-        + plainTextRepoDetails
-        + "\n\n Now, use the provided context of the repo, answer to the point the following question with reference to the repo: "
-        + query
-        + "\n\n Always, just return a brief summary on the answer. Plus, if you are not able to pin point anything just say so."
-    )
-    prompt2 = (
-        openapi.systemPrompt + "\n" + plainTextRepoDetails + "\n" + "Question: " + query
+    # keep the details most relevant to the query, within the token budget
+    repoDetails, promptTokens = prompt_builder.build_details(
+        parsedFiles,
+        query,
+        plainTextRepoDetails,
     )
+    report("digest", {"files": len(parsedFiles), "promptTokens": promptTokens})
+    if "promptTokens" in fields:
+        resp["promptTokens"] = promptTokens
+
+    if "prompt" in fields:
+        resp["prompt"] = (
+            f"For Repo - {repoWithOwner}, these are the extracted details of the files in the repo: \n"
+            + repoDetails
+            + "\n\n Now, use the provided context of the repo, answer to the point the following question with reference to the repo: "
+            + query
+            + "\n\n Always, just return a brief summary on the answer. Plus, if you are not able to pin point anything just say so."
+        )
+    if "prompt2" in fields:
+        resp["prompt2"] = (
+            openapi.systemPrompt + "\n" + repoDetails + "\n" + "Question: " + query
+        )
+    if not fields & ANSWER_FIELDS:
+        return resp
+
+    # structured questions (counts, listings, ...) are answered from the index
+    # of the parsed files, without the llm round trip
+    if repo_index.INDEX_FAST_PATH:
+        indexAnswer = repo_index.answer(repo_index.build_index(parsedFiles), query)
+        if indexAnswer is not None:
+            resp["answeredBy"] = "index"
+            resp["gpt3.5prediction"] = indexAnswer
+            return resp
 
-    resp = {
-        "statusCode": 200,
-        "analysisedRepo": repoWithOwner,
-        "inputQuery": query,
-        "zparsedFiles": parsedFiles,
-        "prompt": prompt,
-        "prompt2": prompt2,
-        "userStats": userStats,
-    }
+    resp["answeredBy"] = "llm"
     try:
         resp["gpt3.5prediction"] = openapi.generate_response(
-            plainTextRepoDetails,
+            repoDetails,
             query,
+            nocache,
+            on_token=progress and (lambda text: report("token", {"text": text})),
         )
     except:
         resp["gpt3.5prediction"] = {
@@ -87,63 +221,214 @@ def analyse_user(username: str, query: str, nocache=False):
     return resp
 
 
+# Returns the repo's (plain text, parsed files) digest. It is cached by the
+# repo's root tree sha and the file selection settings, so the follow-up
+# questions on an unchanged repo skip the fetching, parsing and rendering.
+# Digests missing some files (failed downloads, or a truncated tree) are not
+# cached.
+def repo_digest(owner: str, repo: str, tree: dict, nocache=False, progress=None):
+    if not tree.get("oid"):
+        return process_repo_files_to_plain_text(
+            owner, repo, tree["files"], nocache, progress=progress
+        )
+
+    ckey = f"digests/{digest_settings()}/{tree['oid']}"
+    digest = cache.readJSON(ckey, nocache)
+    if digest is None:
+        with cache.lock(ckey):
+            # built by another worker while we were waiting for the lock
+            digest = None if nocache else cache.readJSON(ckey, count=False)
+            if digest is None:
+                failed = []
+                plainText, parsedFiles = process_repo_files_to_plain_text(
+                    owner, repo, tree["files"], nocache, failed, progress
+                )
+                digest = {"plainText": plainText, "parsedFiles": parsedFiles}
+                if not failed and not tree.get("truncated"):
+                    cache.writeJSON(ckey, digest)
+
+    return digest["plainText"], digest["parsedFiles"]
+
+
+# Returns a short hash of the settings shaping a digest, part of its cache key
+def digest_settings():
+    settings = (
+        DIGEST_VERSION,
+        PARSER_VERSION,
+        MAX_FILES,
+        MAX_FILE_BYTES,
+        MAX_TOTAL_BYTES,
+        SKIP_TEST_FILES,
+        gfiles.TREE_MAX_DEPTH,
+        gfiles.TREE_MAX_QUERIES,
+    )
+    return hashlib.sha1(repr(settings).encode("utf-8")).hexdigest()[:12]
+
+
 def process_repo_files_to_plain_text(
-    repoOwner: str, repoName: str, files: list, nocache=False
+    repoOwner: str,
+    repoName: str,
+    files: list,
+    nocache=False,
+    failed=None,
+    progress=None,
 ):
-    # now, convert each file into corresponding segments
+    # now, convert each file into corresponding segments and render it, as
+    # soon as it is parsed, while the rest are being downloaded
     parsedFiles = []
+    plainText = io.StringIO()
+    if progress is not None:
+        # the files selected, the ones failing to load are not parsed then
+        total = min(sum(1 for _ in select_files(walk_files(files))), MAX_FILES)
+    for parsed in iter_parsed_files(repoOwner, repoName, files, nocache, failed):
+        parsedFiles.append(parsed)
+        if progress is not None:
+            progress(
+                "file",
+                {
+                    "path": parsed["path"],
+                    "parsed": len(parsedFiles),
+                    "total": total,
+                },
+            )
+        for line in render_file(parsed):
+            if plainText.tell():
+                plainText.write("\n")
+            plainText.write(line)
+
+    return plainText.getvalue(), parsedFiles
+
+
+# Yields the parsed files of the repo lazily, through the pipeline:
+#   walk the tree -> select -> load (download) -> parse -> cache the parsed info
+# so only the files in flight are held in memory, never the whole repo
+def iter_parsed_files(owner: str, repo: str, files: list, nocache=False, failed=None):
+    for (file, ckey, cached), info in parse_pool.parse_in_order(
+        parse_items(owner, repo, files, nocache, failed)
+    ):
+        if not cached:
+            cache.writeJSON(ckey, info)
+        yield {
+            "name": file["name"],
+            "path": file["path"],
+            "info": info,
+        }
 
-    def parse_and_store_fnc(file, content: str):
-        # print(file["name"], "started")
-        parsedFiles.append(
-            {
-                "name": file["name"],
-                "path": file["path"],
-                "info": parse_js_file_content(file["name"], content),
-            }
-        )
-        # print(file["name"], "ended")
 
-    # iterate over all files
+# Yields the first MAX_FILES loaded files, to be parsed, as
+# ((file, parsed cache key, cached), name, content, info), with the info when
+# the file's content has been parsed already. The files failing to load are
+# skipped, and appended to failed when given.
+def parse_items(owner: str, repo: str, files: list, nocache=False, failed=None):
+    count = 0
+    selected = select_files(walk_files(files))
+    for file, content, info in load_files(owner, repo, selected, nocache):
+        if info is None and content is None:
+            if failed is not None:
+                failed.append(file)
+            continue
+
+        ckey = parsed_key(file, content)
+        yield (file, ckey, info is not None), file["name"], content, info
+
+        count += 1
+        if count >= MAX_FILES:
+            return
+
+
+# Returns the cache key of the file's parsed info. It is addressed by the
+# content's git blob sha (computed from the content when given, or else known
+# from the tree), so identical contents across repos and analyses are parsed
+# once, and a content downloaded after the tree's oid changed isn't cached
+# under it.
+def parsed_key(file, content=None):
+    oid = utils.blob_oid(content) if content is not None else file.get("oid")
+
+    ext = os.path.splitext(file["name"])[1].lstrip(".")
+    return f"parsed/{PARSER_VERSION}/{ext}/{oid}"
+
+
+# walk_files nestedly in all the directories, yielding files in depth-first order
+def walk_files(files: list):
     for file in files:
-        iterate_files(
-            repoOwner,
-            repoName,
-            file,
-            parsedFiles,
-            parse_and_store_fnc,
-            nocache,
-        )
-    plainTextRepoDetails = convert_to_plain_text(parsedFiles)
-    return plainTextRepoDetails, parsedFiles
+        if file is None:
+            continue
 
+        if "files" in file:
+            # it's directory then
+            yield from walk_files(file["files"])
+            continue
 
-# iterate_files nestedly in all
-def iterate_files(
-    owner: str,
-    repo: str,
-    cur_file,
-    parsedFiles,
-    parse_and_store_fnc,
-    nocache=False,
-):
-    if cur_file is None:
-        return
-
-    if len(parsedFiles) >= 100:
-        return
-
-    if "files" in cur_file:
-        # it's directory then
-        for file in cur_file["files"]:
-            iterate_files(owner, repo, file, parsedFiles, parse_and_store_fnc, nocache)
-        return
-
-    content = utils.download_github_file(
-        owner,
-        repo,
-        path=cur_file["path"],
-        nocache=nocache,
-    )
-    if content is not None:
-        parse_and_store_fnc(cur_file, content)
+        yield file
+
+
+# select_files worth analysing, in the same order, skipping the vendored,
+# generated and too large files, until MAX_TOTAL_BYTES are selected.
+# Files of unknown size (from trees cached before sizes were) are taken as is.
+def select_files(files):
+    total = 0
+    for file in files:
+        parts = file["path"].strip("/").split("/")
+        name = parts[-1]
+        dirs = parts[:-1]
+
+        if any(d in gfiles.SKIP_DIRS for d in dirs) or name.endswith(SKIP_SUFFIXES):
+            continue
+        if SKIP_TEST_FILES and (
+            any(d in TEST_DIRS for d in dirs) or any(m in name for m in TEST_MARKERS)
+        ):
+            continue
+
+        size = file.get("size") or 0
+        if size > MAX_FILE_BYTES or total + size > MAX_TOTAL_BYTES:
+            continue
+
+        total += size
+        yield file
+
+
+# load_files yielding (file, content, info) in the same order, with the parsed
+# info when cached already, without fetching the file, or else its content.
+# Files are taken from the (lazy) selection in chunks of the files still
+# needed to reach limit loaded files, plus LOAD_SLACK for the failing ones,
+# so the cache lookups and fetches stay bounded however many are selected.
+def load_files(owner: str, repo: str, files, nocache=False, limit=MAX_FILES):
+    files = iter(files)
+    loaded = 0
+    while loaded < limit:
+        chunk = list(itertools.islice(files, limit - loaded + LOAD_SLACK))
+        if not chunk:
+            return
+
+        for file, content, info in load_chunk(owner, repo, chunk, nocache):
+            if content is not None or info is not None:
+                loaded += 1
+            yield file, content, info
+
+
+# load_chunk of files, the contents are fetched lazily by gcontents, in bulk
+# when worth it
+def load_chunk(owner: str, repo: str, files: list, nocache=False):
+    infos = [
+        cache.readJSON(parsed_key(file), nocache) if file.get("oid") else None
+        for file in files
+    ]
+    missing = [file for file, info in zip(files, infos) if info is None]
+
+    contents = gcontents.fetch_contents(owner, repo, missing, nocache)
+    try:
+        for file, info in zip(files, infos):
+            if info is not None:
+                yield file, None, info
+                continue
+
+            _, content = next(contents)
+            if content is not None:
+                # not addressable before fetching (without an oid, or changed
+                # since the tree), check by its content
+                ckey = parsed_key(file, content)
+                if ckey != parsed_key(file):
+                    info = cache.readJSON(ckey, nocache)
+            yield file, content, info
+    finally:
+        contents.close()
@@ -0,0 +1,342 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import tempfile
+import threading
+import contextlib
+from internal.lru import LRUCache
+import internal.cache_index as index
+
+# MOUNT_DIRECTORY, the disk cache is disabled when it is not set
+MOUNT_DIRECTORY = os.getenv("MOUNT_DIRECTORY")
+
+# in-memory tier in front of the disk cache for json documents, per worker
+MEMCACHE_MAX_ENTRIES = int(os.getenv("MEMCACHE_MAX_ENTRIES", "1024"))
+MEMCACHE_MAX_BYTES = int(os.getenv("MEMCACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+MEMCACHE_TTL = float(os.getenv("MEMCACHE_TTL", "300"))
+
+# decoded json documents take ~6.6x the bytes of their text in python objects
+# (measured on the parser output), entries are sized by their text times this
+MEMCACHE_OBJECT_FACTOR = float(os.getenv("MEMCACHE_OBJECT_FACTOR", "7"))
+
+memory = LRUCache(MEMCACHE_MAX_ENTRIES, MEMCACHE_MAX_BYTES, MEMCACHE_TTL)
+
+# seconds a worker waits for another one fetching the same key, before
+# fetching it on its own
+CACHE_LOCK_TIMEOUT = float(os.getenv("CACHE_LOCK_TIMEOUT", "30"))
+
+# keys are hashed into a fixed number of lock files per namespace, so they
+# never pile up. Namespaced, as a lock held while the keys of the other
+# namespaces are locked (a digest's, while its files are fetched) would
+# otherwise share their bucket at times, and block on itself
+CACHE_LOCK_BUCKETS = 4096
+
+# seconds between two background sweeps of the disk cache, 0 disables them
+CACHE_SWEEP_INTERVAL = float(os.getenv("CACHE_SWEEP_INTERVAL", "600"))
+
+# Cache keys are namespaced by their first path segment:
+#   users/{username}                      -> user stats (json)
+#   repos/{owner}/{repo}/tree             -> repo file tree (json)
+#   trees/{oid}                           -> a directory's entries (json)
+#   blobs/{oid}                           -> file content by git blob sha (raw)
+#   files/{owner}/{repo}/{branch}/{path}  -> file content by path (raw)
+#   parsed/{version}/{ext}/{oid}          -> parsed file content (json)
+#   digests/{settings}/{tree oid}         -> rendered repo digest (json)
+#   llm/{hash}                            -> llm answer to a question (json)
+#   jobs/{id}                             -> background analysis job (json)
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+_sweeper_pid = None
+_sweeper_lock = threading.Lock()
+
+
+def namespace(key: str):
+    return key.split("/", 1)[0]
+
+
+def filepath(key: str):
+    return MOUNT_DIRECTORY + "/" + key
+
+
+# Returns hits and misses per namespace, counted in this worker process,
+# hits include the ones served from memory
+def stats():
+    with _stats_lock:
+        res = {}
+        for ns, st in _stats.items():
+            total = st["hits"] + st["misses"]
+            res[ns] = {
+                "hits": st["hits"],
+                "memoryHits": st["memoryHits"],
+                "misses": st["misses"],
+                "hitRate": round(st["hits"] / total, 4) if total else 0,
+            }
+        res["memory"] = {"entries": len(memory), "bytes": memory.size}
+
+    if MOUNT_DIRECTORY:
+        res["disk"] = index.usage(MOUNT_DIRECTORY)
+    return res
+
+
+def _count(key: str, hit: bool, inMemory=False):
+    ns = namespace(key)
+    with _stats_lock:
+        st = _stats.setdefault(ns, {"hits": 0, "memoryHits": 0, "misses": 0})
+        st["hits" if hit else "misses"] += 1
+        if inMemory:
+            st["memoryHits"] += 1
+
+
+# Writes to a temp file and renames it over the path, so the readers in the
+# other workers either see the old or the new content, never a partial one
+def writeFile(path: str, txt: str):
+    dirpath = os.path.dirname(path)
+    if dirpath:
+        os.makedirs(dirpath, exist_ok=True)
+
+    fd, tmppath = tempfile.mkstemp(dir=dirpath, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(txt)
+        os.replace(tmppath, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmppath)
+        raise
+
+
+# Reads the key from the disk, if it is indexed and not expired yet, or even
+# if expired with stale=True
+def _read(key: str, stale=False):
+    if not MOUNT_DIRECTORY:
+        return None
+    try:
+        if not index.lookup(MOUNT_DIRECTORY, key, namespace(key), stale):
+            return None
+        with open(filepath(key), "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        index.remove(MOUNT_DIRECTORY, key)
+        return None
+    except (OSError, UnicodeDecodeError, index.sqlite3.Error) as e:
+        print(f"cache: error reading {key}", e)
+        return None
+
+
+def _write(key: str, txt: str):
+    if not MOUNT_DIRECTORY:
+        return
+    writeFile(filepath(key), txt)
+
+    try:
+        index.record(MOUNT_DIRECTORY, key, namespace(key), len(txt.encode("utf-8")))
+    except index.sqlite3.Error as e:
+        print(f"cache: error indexing {key}", e)
+    _start_sweeper()
+
+
+# Holds an exclusive lock on the key across all the workers sharing the
+# MOUNT_DIRECTORY, yields whether the lock was acquired within the timeout.
+# The lock is polled rather than blocked on, so the waiting is interruptible.
+@contextlib.contextmanager
+def lock(key: str, timeout=CACHE_LOCK_TIMEOUT):
+    if not MOUNT_DIRECTORY:
+        yield False
+        return
+
+    bucket = int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:8], 16)
+    lockdir = MOUNT_DIRECTORY + "/.locks"
+    os.makedirs(lockdir, exist_ok=True)
+
+    fd = os.open(
+        f"{lockdir}/{namespace(key)}-{bucket % CACHE_LOCK_BUCKETS}",
+        os.O_RDWR | os.O_CREAT,
+    )
+    try:
+        locked = False
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(0.05)
+        yield locked
+    finally:
+        # closing the file releases the lock
+        os.close(fd)
+
+
+# Returns the cached json document of the key, or else calls fetch for it.
+# When several workers miss the same key, only one of them fetches it, while
+# the others wait for it and reuse the cached result.
+# Results carrying an "error" are returned but never cached, and when rate
+# limited, the expired cached document is served instead, if any. Neither are
+# the results for which cacheable, if given, returns False.
+def fetchJSON(key: str, fetch, nocache=False, cacheable=None):
+    data = readJSON(key, nocache)
+    if data is not None:
+        return data
+
+    with lock(key):
+        if not nocache:
+            # filled by another worker while we were waiting for the lock,
+            # counted already as a miss
+            data = readJSON(key, count=False)
+            if data is not None:
+                return data
+
+        data = fetch()
+        if isinstance(data, dict) and "error" in data:
+            if data.get("statusCode") == 429:
+                return readStaleJSON(key) or data
+            return data
+
+        if data is not None and (cacheable is None or cacheable(data)):
+            writeJSON(key, data)
+        return data
+
+
+# Same as fetchJSON, for raw text blobs, None results are not cached
+def fetchBlob(key: str, fetch, nocache=False, cacheable=None):
+    data = readBlob(key, nocache)
+    if data is not None:
+        return data
+
+    with lock(key):
+        if not nocache:
+            data = readBlob(key, count=False)
+            if data is not None:
+                return data
+
+        data = fetch()
+        if data is not None and (cacheable is None or cacheable(data)):
+            writeBlob(key, data)
+        return data
+
+
+# Removes the expired entries and evicts the least recently (or frequently)
+# used ones over the CACHE_MAX_BYTES budget, returns the number of removed keys
+def sweep():
+    if not MOUNT_DIRECTORY:
+        return 0
+
+    removed = index.sweep(MOUNT_DIRECTORY)
+    for key in removed:
+        memory.delete(key)
+        try:
+            os.remove(filepath(key))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"cache: error removing {key}", e)
+    return len(removed)
+
+
+# Starts the background sweeper thread of this worker, once
+def _start_sweeper():
+    global _sweeper_pid
+    if CACHE_SWEEP_INTERVAL <= 0 or _sweeper_pid == os.getpid():
+        return
+
+    def loop():
+        while True:
+            time.sleep(CACHE_SWEEP_INTERVAL)
+            try:
+                sweep()
+            except Exception as e:
+                print("cache: sweep failed", e)
+
+    with _sweeper_lock:
+        if _sweeper_pid != os.getpid():
+            threading.Thread(target=loop, name="cache-sweeper", daemon=True).start()
+            _sweeper_pid = os.getpid()
+
+
+# Returns the estimated bytes of the decoded json text in memory
+def memorySize(txt: str):
+    return int(len(txt) * MEMCACHE_OBJECT_FACTOR)
+
+
+# Reads a json document from memory, or else from the disk, None on miss.
+# Counted in the stats, unless count is False, like for the reads again of a
+# key counted already.
+def readJSON(key: str, nocache=False, count=True):
+    if nocache:
+        return None
+
+    data = memory.get(key)
+    if data is not None:
+        if count:
+            _count(key, True, inMemory=True)
+        return data
+
+    txt = _read(key)
+    if txt is not None:
+        try:
+            data = json.loads(txt)
+            memory.set(key, data, memorySize(txt))
+        except ValueError as e:
+            print(f"cache: corrupted json at {key}", e)
+
+    if count:
+        _count(key, data is not None)
+    return data
+
+
+def writeJSON(key: str, data):
+    txt = json.dumps(data)
+    memory.set(key, data, memorySize(txt))
+    _write(key, txt)
+
+
+# Reads a json document, even if expired, marked with "stale": True.
+# Used as the fallback when github can't be queried, like on rate limiting.
+def readStaleJSON(key: str):
+    data = memory.get(key)
+    if data is None:
+        txt = _read(key, stale=True)
+        if txt is None:
+            return None
+        try:
+            data = json.loads(txt)
+        except ValueError:
+            return None
+
+    if isinstance(data, dict):
+        data = dict(data, stale=True)
+    return data
+
+
+# Reads a raw text blob (like file content) from the cache, None on miss
+def readBlob(key: str, nocache=False, count=True):
+    if nocache:
+        return None
+
+    data = _read(key)
+    if count:
+        _count(key, data is not None)
+    return data
+
+
+def writeBlob(key: str, txt: str):
+    _write(key, txt)
+
+
+def appendData(key: str, txt: str):
+    if not MOUNT_DIRECTORY:
+        return
+    path = filepath(key)
+    dirpath = os.path.dirname(path)
+    if dirpath:
+        os.makedirs(dirpath, exist_ok=True)
+
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(txt)
@@ -0,0 +1,193 @@
+import os
+import time
+import sqlite3
+import threading
+
+# The index keeps one row per file in the disk cache, with its size and access
+# times, so expiry and eviction never have to walk the MOUNT_DIRECTORY tree.
+# It is a sqlite database shared by all the workers using the directory.
+
+# per namespace ttl in seconds, 0 means the entries never expire
+CACHE_TTL_DEFAULT = float(os.getenv("CACHE_TTL_DEFAULT", "86400"))
+CACHE_TTLS = {
+    "users": float(os.getenv("CACHE_TTL_USERS", "86400")),
+    "repos": float(os.getenv("CACHE_TTL_REPOS", "21600")),
+    # trees, blobs, parsed files and repo digests are addressed by their git
+    # sha, so their content can never be stale
+    "trees": float(os.getenv("CACHE_TTL_TREES", "2592000")),
+    "blobs": float(os.getenv("CACHE_TTL_BLOBS", "2592000")),
+    "files": float(os.getenv("CACHE_TTL_FILES", "86400")),
+    "parsed": float(os.getenv("CACHE_TTL_PARSED", "2592000")),
+    "digests": float(os.getenv("CACHE_TTL_DIGESTS", "2592000")),
+    "llm": float(os.getenv("CACHE_TTL_LLM", "604800")),
+    "jobs": float(os.getenv("CACHE_TTL_JOBS", "86400")),
+}
+
+# seconds the expired entries are kept past their ttl (unless evicted for the
+# bytes budget), to be served stale when github can't be queried
+CACHE_STALE_GRACE = float(os.getenv("CACHE_STALE_GRACE", "604800"))
+
+# total bytes budget of the disk cache, and the eviction policy: lru or lfu
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+CACHE_EVICTION = os.getenv("CACHE_EVICTION", "lru")
+
+# access times are only updated once in this many seconds per entry
+CACHE_TOUCH_INTERVAL = 60
+
+_local = threading.local()
+
+
+def ttl(ns: str):
+    return CACHE_TTLS.get(ns, CACHE_TTL_DEFAULT)
+
+
+# Returns the sqlite connection of the current thread, None if disabled
+def connection(directory: str):
+    if not directory:
+        return None
+
+    pid = os.getpid()
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == pid:
+        return conn
+
+    os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(
+        os.path.join(directory, ".index.sqlite3"),
+        timeout=10,
+        isolation_level=None,  # autocommit
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            namespace TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            createdAt REAL NOT NULL,
+            accessedAt REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )"""
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessedAt)")
+    _local.conn = conn
+    _local.pid = pid
+    return conn
+
+
+# Returns whether the key is cached and still fresh (or expired, with
+# stale=True), and marks it accessed
+def lookup(directory: str, key: str, ns: str, stale=False):
+    conn = connection(directory)
+    if conn is None:
+        return False
+
+    row = conn.execute(
+        "SELECT createdAt, accessedAt FROM entries WHERE key = ?", (key,)
+    ).fetchone()
+    if row is None:
+        return False
+
+    now = time.time()
+    createdAt, accessedAt = row
+    limit = ttl(ns)
+    if not stale and limit > 0 and createdAt + limit < now:
+        return False
+
+    if now - accessedAt > CACHE_TOUCH_INTERVAL:
+        conn.execute(
+            "UPDATE entries SET accessedAt = ?, hits = hits + 1 WHERE key = ?",
+            (now, key),
+        )
+    return True
+
+
+def record(directory: str, key: str, ns: str, size: int):
+    conn = connection(directory)
+    if conn is None:
+        return
+
+    now = time.time()
+    conn.execute(
+        """INSERT INTO entries (key, namespace, size, createdAt, accessedAt)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET
+            size = excluded.size,
+            createdAt = excluded.createdAt,
+            accessedAt = excluded.accessedAt""",
+        (key, ns, size, now, now),
+    )
+
+
+def remove(directory: str, key: str):
+    conn = connection(directory)
+    if conn is None:
+        return
+    conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+
+# Returns the number of entries and bytes used per namespace
+def usage(directory: str):
+    conn = connection(directory)
+    if conn is None:
+        return {}
+
+    rows = conn.execute(
+        "SELECT namespace, COUNT(*), SUM(size) FROM entries GROUP BY namespace"
+    ).fetchall()
+    return {ns: {"entries": count, "bytes": size} for ns, count, size in rows}
+
+
+# Removes the entries expired for longer than CACHE_STALE_GRACE, then evicts
+# entries until the cache fits in 90% of CACHE_MAX_BYTES. Returns the keys
+# removed from the index, the caller deletes the files.
+def sweep(directory: str):
+    conn = connection(directory)
+    if conn is None:
+        return []
+
+    now = time.time()
+    removed = []
+
+    # expired entries
+    for ns, limit in list(CACHE_TTLS.items()) + [(None, CACHE_TTL_DEFAULT)]:
+        if limit <= 0:
+            continue
+        if ns is None:
+            marks = ",".join("?" * len(CACHE_TTLS))
+            rows = conn.execute(
+                f"SELECT key FROM entries WHERE namespace NOT IN ({marks}) AND createdAt < ?",
+                (*CACHE_TTLS.keys(), now - limit - CACHE_STALE_GRACE),
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT key FROM entries WHERE namespace = ? AND createdAt < ?",
+                (ns, now - limit - CACHE_STALE_GRACE),
+            ).fetchall()
+        removed.extend(key for (key,) in rows)
+    _delete(conn, removed)
+
+    # over the budget, evict by the policy
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+    target = CACHE_MAX_BYTES * 0.9
+    if total > CACHE_MAX_BYTES:
+        order = "hits, accessedAt" if CACHE_EVICTION == "lfu" else "accessedAt"
+        evicted = []
+        for key, size in conn.execute(
+            f"SELECT key, size FROM entries ORDER BY {order}"
+        ):
+            if total <= target:
+                break
+            evicted.append(key)
+            total -= size
+        _delete(conn, evicted)
+        removed.extend(evicted)
+
+    return removed
+
+
+def _delete(conn, keys: list):
+    for i in range(0, len(keys), 500):
+        chunk = keys[i : i + 500]
+        marks = ",".join("?" * len(chunk))
+        conn.execute(f"DELETE FROM entries WHERE key IN ({marks})", chunk)
@@ -0,0 +1,229 @@
+import internal.utils as utils
+import internal.cache as cache
+import internal.fetch_stats as gstats
+import requests
+import tarfile
+import os
+
+# how the file contents are fetched: "file" (one raw download per file),
+# "graphql" (blob texts aliased in batched queries), "archive" (one tarball
+# of the repo, filtered while streaming) or "auto" to choose per repo
+CONTENT_STRATEGY = os.getenv("CONTENT_STRATEGY", "auto")
+
+# below this many files to fetch, per file downloads are the fastest
+BULK_MIN_FILES = int(os.getenv("BULK_MIN_FILES", "5"))
+
+# up to these total bytes, the graphql batches are used, beyond it the archive.
+# The files fetched for a repo total MAX_TOTAL_BYTES at most (1.5 MiB), so keep
+# it below that, or the archive is never used
+GRAPHQL_MAX_BYTES = int(os.getenv("GRAPHQL_MAX_BYTES", str(512 * 1024)))
+
+# files and bytes per graphql batch, and the batches fetched concurrently
+GRAPHQL_BLOB_BATCH_SIZE = int(os.getenv("GRAPHQL_BLOB_BATCH_SIZE", "25"))
+GRAPHQL_BLOB_BATCH_BYTES = int(os.getenv("GRAPHQL_BLOB_BATCH_BYTES", str(512 * 1024)))
+BULK_WORKERS = int(os.getenv("BULK_WORKERS", "4"))
+
+# number of files downloaded concurrently for a repo, with the "file" strategy
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "16"))
+
+
+# Chooses the strategy to fetch the files by their count and total byteSize
+def choose_strategy(files: list):
+    if CONTENT_STRATEGY != "auto":
+        return CONTENT_STRATEGY
+
+    if len(files) < BULK_MIN_FILES:
+        return "file"
+    if sum(file.get("size") or 0 for file in files) <= GRAPHQL_MAX_BYTES:
+        return "graphql"
+    return "archive"
+
+
+# Fetches the files' contents, yielding (file, content) in the same order,
+# content is None when it can't be fetched. Lazy, so the files after the ones
+# we stop consuming at are fetched as little as possible.
+def fetch_contents(owner: str, repo: str, files: list, nocache=False):
+    strategy = choose_strategy(files)
+    if strategy == "file":
+        yield from zip(files, fetch_each(owner, repo, files, nocache))
+        return
+
+    # contents cached already, the rest are fetched in bulk
+    contents = [
+        cache.readBlob(
+            utils.content_key(owner, repo, file["path"], oid=file.get("oid")),
+            nocache,
+        )
+        for file in files
+    ]
+    missing = [file for file, content in zip(files, contents) if content is None]
+    if strategy == "archive":
+        batches = [(missing, fetch_archive(owner, repo, missing))]
+    else:
+        batches = fetch_graphql(owner, repo, missing)
+
+    fetched = complete_batches(owner, repo, batches, nocache)
+    try:
+        for file, content in zip(files, contents):
+            if content is None:
+                content = next(fetched)
+            yield file, content
+    finally:
+        fetched.close()
+
+
+# Yields the contents of the bulk fetched batches of (files, contents) in
+# order, caching them. The files missing from a batch (like truncated texts,
+# or all of them when its query failed) are downloaded, concurrently.
+# Contents are only cached under the file's oid when they hash to it, as the
+# archive is of HEAD, which may have moved on since the tree was fetched.
+def complete_batches(owner: str, repo: str, batches, nocache=False):
+    for files, contents in batches:
+        retry = [file for file, content in zip(files, contents) if content is None]
+        downloaded = fetch_each(owner, repo, retry, nocache)
+        try:
+            for file, content in zip(files, contents):
+                if content is None:
+                    content = next(downloaded)
+                else:
+                    oid = file.get("oid")
+                    if not oid or utils.blob_oid(content) == oid:
+                        cache.writeBlob(
+                            utils.content_key(owner, repo, file["path"], oid=oid),
+                            content,
+                        )
+                yield content
+        finally:
+            downloaded.close()
+
+
+# Downloads the files one by one, DOWNLOAD_WORKERS of them concurrently
+def fetch_each(owner: str, repo: str, files: list, nocache=False):
+    return utils.ordered_map(
+        lambda file: utils.download_github_file(
+            owner,
+            repo,
+            path=file["path"],
+            nocache=nocache,
+            oid=file.get("oid"),
+        ),
+        files,
+        DOWNLOAD_WORKERS,
+    )
+
+
+# Fetches the blob texts in batched graphql queries, yielding the batches as
+# (files, contents) in the same order, BULK_WORKERS batches at a time
+def fetch_graphql(owner: str, repo: str, files: list):
+    batches = []
+    for file in files:
+        size = file.get("size") or 0
+        if (
+            not batches
+            or len(batches[-1][0]) >= GRAPHQL_BLOB_BATCH_SIZE
+            or batches[-1][1] + size > GRAPHQL_BLOB_BATCH_BYTES
+        ):
+            batches.append(([], 0))
+        batch, total = batches[-1]
+        batch.append(file)
+        batches[-1] = (batch, total + size)
+
+    return utils.ordered_map(
+        lambda batch: (batch[0], query_blobs(owner, repo, batch[0])),
+        batches,
+        BULK_WORKERS,
+    )
+
+
+# Queries the blob texts of the files, aliased as b0, b1, ..., addressed by
+# their sha, or else their HEAD:path expression
+def query_blobs(owner: str, repo: str, files: list):
+    variables = {"owner": owner.strip(), "repo": repo.strip()}
+    args = []
+    blobs = []
+    for i, file in enumerate(files):
+        if file.get("oid"):
+            variables[f"b{i}"] = file["oid"]
+            args.append(f"$b{i}: GitObjectID!")
+            blobs.append(
+                f"\n\t\tb{i}: object(oid: $b{i}) {{\n\t\t\t...BlobText\n\t\t}}\n"
+            )
+        else:
+            variables[f"b{i}"] = "HEAD:" + file["path"].lstrip("/")
+            args.append(f"$b{i}: String!")
+            blobs.append(
+                f"\n\t\tb{i}: object(expression: $b{i}) {{\n\t\t\t...BlobText\n\t\t}}\n"
+            )
+
+    query = (
+        f"\nquery ($owner: String!, $repo: String!, {', '.join(args)}) {{"
+        + gstats.RATE_LIMIT_FIELDS
+        + "\n\trepository(owner: $owner, name: $repo) {"
+        + "".join(blobs)
+        + "\t}\n}\n"
+        + BLOB_FRAGMENT
+    )
+    try:
+        resp = utils.fetch_github_query(query, variables, partial=True)
+    except requests.RequestException as e:
+        # the batch is downloaded file by file instead
+        print(f"Error fetching blobs of {owner}/{repo}", e)
+        return [None] * len(files)
+    if "error" in resp or resp["data"].get("repository") is None:
+        print(f"Error fetching blobs of {owner}/{repo}:", resp.get("error"))
+        return [None] * len(files)
+
+    repository = resp["data"]["repository"]
+    contents = []
+    for i in range(len(files)):
+        blob = repository.get(f"b{i}") or {}
+        if blob.get("isBinary") or blob.get("isTruncated"):
+            contents.append(None)
+        else:
+            contents.append(blob.get("text"))
+    return contents
+
+
+# Streams the repo's tarball, keeping the contents of the files only
+def fetch_archive(owner: str, repo: str, files: list):
+    contents = [None] * len(files)
+    wanted = {file["path"].lstrip("/"): i for i, file in enumerate(files)}
+    if not wanted:
+        return contents
+
+    url = f"https://github.com/{owner}/{repo}/archive/HEAD.tar.gz"
+    try:
+        session = utils.get_session()
+        with session.get(url, stream=True, timeout=utils.HTTP_TIMEOUT) as resp:
+            if resp.status_code != 200:
+                print(f"Error downloading archive {owner}/{repo}: {resp.status_code}")
+                return contents
+
+            with tarfile.open(fileobj=resp.raw, mode="r|gz") as tar:
+                left = len(wanted)
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    # members are prefixed with the "{repo}-{sha}/" directory
+                    i = wanted.get(member.name.split("/", 1)[-1])
+                    if i is None:
+                        continue
+
+                    data = tar.extractfile(member).read()
+                    contents[i] = data.decode("utf-8", errors="replace")
+                    left -= 1
+                    if left == 0:
+                        break
+    except (requests.RequestException, tarfile.TarError, OSError) as e:
+        print(f"Error downloading archive {owner}/{repo}", e)
+
+    return contents
+
+
+BLOB_FRAGMENT = """
+fragment BlobText on Blob {
+	isBinary
+	isTruncated
+	text
+}
+"""
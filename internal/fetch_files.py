@@ -1,6 +1,29 @@
 import internal.utils as utils
 import internal.fetch_stats as gstats
-import json
+import internal.cache as cache
+import internal.singleflight as singleflight
+from collections import deque
+import os
+
+# subtrees fetched per query, the depth explored and the queries spent per repo
+TREE_BATCH_SIZE = int(os.getenv("TREE_BATCH_SIZE", "20"))
+TREE_MAX_DEPTH = int(os.getenv("TREE_MAX_DEPTH", "8"))
+TREE_MAX_QUERIES = int(os.getenv("TREE_MAX_QUERIES", "10"))
+
+# directories holding vendored, generated or build output code, not explored
+SKIP_DIRS = {
+    "node_modules",
+    "bower_components",
+    "vendor",
+    "dist",
+    "build",
+    "out",
+    "coverage",
+    ".next",
+    ".nuxt",
+    ".cache",
+    ".git",
+}
 
 
 # find js repo
@@ -28,45 +51,113 @@ def find_js_repo(repos):
     return None
 
 
-# Function to fetch files
+# Function to fetch files, returns the repo's nested file list
 def fetch_repo_files(owner: str, repo: str, nocache=False):
-    ckey = "-" + owner + "-" + repo
-    cval = utils.readData(ckey, nocache)
-    if cval is not None:
-        return cval
-
-    resp = utils.fetch_github_query(
-        FILES_GRAPHQL_QUERY,
-        {
-            "owner": owner.strip(),
-            "repo": repo.strip(),
-        },
+    tree = fetch_repo_tree(owner, repo, nocache)
+    if "error" in tree:
+        return tree  # error
+    return tree["files"]
+
+
+# Function to fetch the repo's tree, as {"oid": root tree sha, "files": [...]},
+# concurrent calls for the same repo are shared. Trees truncated by a failed
+# query are marked "truncated": True, and not cached.
+def fetch_repo_tree(owner: str, repo: str, nocache=False):
+    ckey = f"repos/{owner}/{repo}/tree"
+    return singleflight.do(
+        f"{ckey.lower()}/{nocache}",
+        lambda: cache.fetchJSON(
+            ckey,
+            lambda: query_repo_tree(owner, repo),
+            nocache,
+            cacheable=lambda tree: not tree.get("truncated"),
+        ),
     )
-    if "error" in resp:
-        return resp
-
-    list = []
-    repo = resp["data"]["repository"]
-    if repo is not None:
-        tree = repo["object"]
-        list = parse_tree(tree)
-
-    utils.writeData(ckey, json.dumps(list))
-    return list
 
 
-# parse repo tree to file list
-def parse_tree(tree, prefix="/"):
-    if tree is None:
-        return []
+# Queries the repo's tree from github breadth first, level by level, with up
+# to TREE_BATCH_SIZE subtrees aliased in a query, so the cost of a query stays
+# bounded however wide or deep the repo is. Subtrees are addressed by their
+# sha, and cached by it, so unchanged directories are never queried again.
+# Stops at TREE_MAX_DEPTH or after TREE_MAX_QUERIES, the directories left
+# unexplored are listed without files.
+def query_repo_tree(owner: str, repo: str):
+    levels = {}  # path prefix -> entries of the directory
+    queue = deque([("/", None, 0)])  # (path prefix, tree sha, depth)
+    rootOid = None
+    queries = 0
+    truncated = False
+
+    def explore(prefix: str, entries: list, depth: int):
+        levels[prefix] = entries
+        if depth >= TREE_MAX_DEPTH:
+            return
+        for entry in entries:
+            if entry["type"] == "tree" and entry["name"] not in SKIP_DIRS:
+                queue.append((prefix + entry["name"] + "/", entry["oid"], depth + 1))
+
+    while queue and queries < TREE_MAX_QUERIES:
+        batch = []
+        while queue and len(batch) < TREE_BATCH_SIZE:
+            prefix, oid, depth = queue.popleft()
+            entries = cache.readJSON(f"trees/{oid}") if oid else None
+            if entries is not None:
+                explore(prefix, entries, depth)
+            else:
+                batch.append((prefix, oid, depth))
+        if not batch:
+            continue
 
-    entries = tree.get("entries", [])
+        variables = {"owner": owner.strip(), "repo": repo.strip()}
+        for i, (_, oid, _) in enumerate(batch):
+            if oid is not None:
+                variables[f"o{i}"] = oid
+        resp = utils.fetch_github_query(
+            build_tree_query([oid is None for _, oid, _ in batch]),
+            variables,
+        )
+        queries += 1
+        if "error" in resp:
+            if rootOid is None:
+                return resp
+            # keep the part of the tree fetched so far, marked as such
+            print(f"tree of {owner}/{repo} truncated:", resp["error"])
+            truncated = True
+            break
+
+        repository = resp["data"]["repository"]
+        if repository is None:
+            return {"oid": None, "files": []}
+
+        for i, (prefix, oid, depth) in enumerate(batch):
+            tree = repository.get(f"t{i}") or {}
+            entries = [
+                {
+                    "name": entry["name"],
+                    "type": entry["type"],
+                    "oid": entry["oid"],
+                    "size": (entry.get("object") or {}).get("byteSize"),
+                }
+                for entry in tree.get("entries") or []
+                if entry is not None
+            ]
+            if oid is None:
+                rootOid = tree.get("oid")
+            elif entries:
+                cache.writeJSON(f"trees/{oid}", entries)
+            explore(prefix, entries, depth)
+
+    tree = {"oid": rootOid, "files": build_tree(levels)}
+    if truncated:
+        tree["truncated"] = True
+    return tree
+
+
+# Builds the nested file list, of js/ts files only, from the fetched levels
+def build_tree(levels: dict, prefix="/"):
     parsed_entries = []
 
-    for entry in entries:
-        if entry is None:
-            continue
-
+    for entry in levels.get(prefix, []):
         name = str(entry.get("name", ""))
         ftype = entry["type"]
 
@@ -85,72 +176,51 @@ def parse_tree(tree, prefix="/"):
             "path": prefix + name,
         }
 
+        if ftype == "blob":
+            node["oid"] = entry["oid"]
+            if entry.get("size") is not None:
+                node["size"] = entry["size"]
+
         if ftype == "tree":
-            node["files"] = parse_tree(entry["object"], prefix + name + "/")
+            node["files"] = build_tree(levels, prefix + name + "/")
 
         parsed_entries.append(node)
 
     return parsed_entries
 
 
-FILES_GRAPHQL_QUERY = """
-query ($owner: String!, $repo: String!) {
-	rateLimit {
-		cost
-		limit
-		nodeCount
-		remaining
-		resetAt
-		used
-	}
+# Builds the query fetching the trees in one call, aliased as t0, t1, ...
+# The root tree is addressed by the HEAD: expression, the rest by their sha $oN
+def build_tree_query(isRoot: list):
+    variables = "".join(
+        f", $o{i}: GitObjectID!" for i, root in enumerate(isRoot) if not root
+    )
+    trees = "".join(
+        f'\n\t\tt{i}: object(expression: "HEAD:") {{\n\t\t\t...TreeEntries\n\t\t}}\n'
+        if root
+        else f"\n\t\tt{i}: object(oid: $o{i}) {{\n\t\t\t...TreeEntries\n\t\t}}\n"
+        for i, root in enumerate(isRoot)
+    )
+    return (
+        f"\nquery ($owner: String!, $repo: String!{variables}) {{"
+        + gstats.RATE_LIMIT_FIELDS
+        + "\n\trepository(owner: $owner, name: $repo) {"
+        + trees
+        + "\t}\n}\n"
+        + TREE_FRAGMENT
+    )
+
 
-	repository(owner: $owner, name: $repo) {
-		object(expression: "HEAD:") {
-			... on Tree {
-				entries {
-					name
-					type
-					object {
-						... on Blob {
-							byteSize
-						}
-						... on Tree {
-							entries {
-								name
-								type
-								object {
-									__typename
-									... on Blob {
-										byteSize
-									}
-									... on Tree {
-										entries {
-											name
-											type
-											object {
-												... on Blob {
-													byteSize
-												}
-
-												... on Tree {
-													entries {
-														name
-														type
-														object {
-															... on Blob {
-																byteSize
-															}
-														}
-													}
-												}
-											}
-										}
-									}
-								}
-							}
-						}
-					}
-				}
+TREE_FRAGMENT = """
+fragment TreeEntries on Tree {
+	oid
+	entries {
+		name
+		type
+		oid
+		object {
+			... on Blob {
+				byteSize
 			}
 		}
 	}
@@ -1,14 +1,66 @@
 import internal.utils as utils
-import json
+import internal.cache as cache
+import internal.singleflight as singleflight
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+# users packed in a single batch query, each one costs ~500 nodes of the
+# 500,000 node limit, kept small so a slow or failing batch affects few users
+BATCH_USERS_PER_QUERY = int(os.getenv("BATCH_USERS_PER_QUERY", "10"))
+
+# batch queries sent concurrently, and the maximum users in a batch request
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "4"))
+BATCH_MAX_USERS = int(os.getenv("BATCH_MAX_USERS", "500"))
+
+# fields of the user stats per view, the default view "full" has all of them
+USER_VIEWS = {
+    "summary": {
+        "bio",
+        "name",
+        "username",
+        "createdAt",
+        "updatedAt",
+        "location",
+        "twitterUsername",
+        "isDeveloperProgramMember",
+        "totalRepositories",
+        "followers",
+        "following",
+        "hasSponsorsListing",
+        "totalSponsors",
+        "totalSponsorshipAmountAsSponsorInCents",
+        "totalSponsorings",
+        "totalStarredRepositories",
+        "totalStarsReceived",
+    },
+}
+USER_VIEWS["full"] = USER_VIEWS["summary"] | {
+    "socialAccounts",
+    "oneYearContributionsStats",
+    "topRepositories",
+    "recentlyContributedRepositories",
+}
 
 
-# Function to fetch user data
+# Function to fetch user data, concurrent calls for the same user are shared
 def fetch_user_data(username: str, nocache=False):
-    ckey = username
-    cval = utils.readData(ckey, nocache)
-    if cval is not None:
-        return cval
+    ckey = f"users/{username}"
+    return singleflight.do(
+        f"{ckey.lower()}/{nocache}",
+        lambda: cache.fetchJSON(ckey, lambda: query_user_data(username), nocache),
+    )
 
+
+# Returns the user data response with only the fields of its data asked for,
+# without copying the (cached) data's fields
+def project_user_response(resp, fields=None):
+    if fields is None or resp is None or "error" in resp:
+        return resp
+    return dict(resp, data={k: v for k, v in resp["data"].items() if k in fields})
+
+
+# Queries the user data from github
+def query_user_data(username: str):
     resp = utils.fetch_github_query(
         GRAPHQL_QUERY,
         {
@@ -20,13 +72,87 @@ def fetch_user_data(username: str, nocache=False):
 
     usr = resp["data"]["user"]
     usr = format_user_response(usr)
-    data = {
+    return {
         "data": usr,
         "statusCode": 200,
     }
 
-    utils.writeData(ckey, json.dumps(data))
-    return data
+
+# Function to fetch multiple users data, returns the result per username.
+# Cached users are served from the cache, the rest are queried in batches.
+def fetch_users_data(usernames: list, nocache=False):
+    results = {}
+    missing = []
+    for username in dict.fromkeys(usernames):
+        cval = cache.readJSON(f"users/{username}", nocache)
+        if cval is not None:
+            results[username] = cval
+        else:
+            missing.append(username)
+
+    batches = [
+        missing[i : i + BATCH_USERS_PER_QUERY]
+        for i in range(0, len(missing), BATCH_USERS_PER_QUERY)
+    ]
+    if batches:
+        with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(batches))) as pool:
+            for batch in pool.map(query_users_data, batches):
+                results.update(batch)
+
+    return {username: results[username] for username in dict.fromkeys(usernames)}
+
+
+# Queries the users data from github in a single aliased query
+def query_users_data(usernames: list):
+    resp = utils.fetch_github_query(
+        build_batch_query(len(usernames)),
+        {f"u{i}": username.strip() for i, username in enumerate(usernames)},
+        partial=True,
+        priority="low",
+    )
+    if "error" in resp:
+        results = {}
+        for username in usernames:
+            # serve the expired cache, rather than nothing, when rate limited
+            stale = None
+            if resp["statusCode"] == 429:
+                stale = cache.readStaleJSON(f"users/{username}")
+            results[username] = stale or resp
+        return results
+
+    # errors of the aliased users, by their alias
+    errors = {}
+    for error in resp.get("errors", []):
+        path = error.get("path")
+        if path:
+            errors[path[0]] = error
+
+    results = {}
+    for i, username in enumerate(usernames):
+        usr = resp["data"].get(f"u{i}")
+        if usr is None:
+            error = errors.get(f"u{i}", {})
+            if error.get("type") == "NOT_FOUND":
+                results[username] = {
+                    "statusCode": 404,
+                    "error": f"{username} not found",
+                }
+            else:
+                print("something went wrong:", username, error)
+                results[username] = {
+                    "statusCode": 500,
+                    "error": "500 - Something went wrong",
+                }
+            continue
+
+        data = {
+            "data": format_user_response(usr),
+            "statusCode": 200,
+        }
+        cache.writeJSON(f"users/{username}", data)
+        results[username] = data
+
+    return results
 
 
 # Formats the github api response, based on the graphql query
@@ -119,133 +245,122 @@ def format_repos_response(res):
     return repo
 
 
-# Github Graphql Query used to obtained data
-GRAPHQL_QUERY = """
-query ($username: String!) {
-	rateLimit {
-		cost
-		limit
-		nodeCount
-		remaining
-		resetAt
-		used
+# Github Graphql fragments for the user's details, shared by the queries
+USER_FRAGMENTS = """
+fragment UserDetails on User {
+	name
+	twitterUsername
+	username: login
+	createdAt
+	updatedAt
+	location
+
+	bio
+	socialAccounts(first: 5) {
+		nodes {
+			displayName
+			provider
+			url
+		}
+		totalCount
 	}
 
-	user(login: $username) {
-		name
-		twitterUsername
-		username: login
-		createdAt
-		updatedAt
-		location
-
-		bio
-		socialAccounts(first: 5) {
-			nodes {
-				displayName
-				provider
+	isDeveloperProgramMember
+
+	# contributions stats in past 1 years
+	oneYearContributionsStats: contributionsCollection {
+		startedAt
+		endedAt
+
+		restrictedContributionsCount
+
+		totalIssueContributions
+		totalCommitContributions
+		totalPullRequestContributions
+		totalPullRequestReviewContributions
+
+		totalRepositoryContributions
+		totalRepositoriesWithContributedIssues
+		totalRepositoriesWithContributedCommits
+		totalRepositoriesWithContributedPullRequests
+		totalRepositoriesWithContributedPullRequestReviews
+
+		popularIssueContribution {
+			isRestricted
+			issue {
+				title
+				# bodyText
+				createdAt
+				closedAt
 				url
 			}
-			totalCount
 		}
 
-		isDeveloperProgramMember
-
-		# contributions stats in past 1 years
-		oneYearContributionsStats: contributionsCollection {
-			startedAt
-			endedAt
-
-			restrictedContributionsCount
-
-			totalIssueContributions
-			totalCommitContributions
-			totalPullRequestContributions
-			totalPullRequestReviewContributions
-
-			totalRepositoryContributions
-			totalRepositoriesWithContributedIssues
-			totalRepositoriesWithContributedCommits
-			totalRepositoriesWithContributedPullRequests
-			totalRepositoriesWithContributedPullRequestReviews
-
-			popularIssueContribution {
-				isRestricted
-				issue {
-					title
-					# bodyText
-					createdAt
-					closedAt
-					url
-				}
-			}
-
-			popularPullRequestContribution {
-				isRestricted
-				pullRequest {
-					url
-					title
-					# bodyText
-					createdAt
-					changedFiles
-					reviewDecision
-				}
+		popularPullRequestContribution {
+			isRestricted
+			pullRequest {
+				url
+				title
+				# bodyText
+				createdAt
+				changedFiles
+				reviewDecision
 			}
-
-			hasAnyContributions
 		}
 
-		# top repositories user has contributed to in any way
-		topRepositories(
-			first: 50
-			orderBy: { direction: DESC, field: STARGAZERS }
-		) {
-			nodes {
-				...RepoDetails
-			}
-		}
+		hasAnyContributions
+	}
 
-		followers {
-			totalCount
-		}
-		following {
-			totalCount
+	# top repositories user has contributed to in any way
+	topRepositories(
+		first: 50
+		orderBy: { direction: DESC, field: STARGAZERS }
+	) {
+		nodes {
+			...RepoDetails
 		}
+	}
 
-		# number of repositories the user has starred
-		starredRepositories {
-			totalCount
-		}
+	followers {
+		totalCount
+	}
+	following {
+		totalCount
+	}
 
-		# recently contributed repos
-		recentlyContributedTo: repositoriesContributedTo(first: 10) {
-			nodes {
-				...RepoDetails
-			}
-		}
+	# number of repositories the user has starred
+	starredRepositories {
+		totalCount
+	}
 
-		# for stars calculations only considering top 100
-		repositories(
-			first: 100
-			ownerAffiliations: [OWNER, ORGANIZATION_MEMBER, COLLABORATOR]
-			orderBy: { direction: DESC, field: STARGAZERS }
-		) {
-			totalCount
-			nodes {
-				url
-				stargazerCount
-			}
+	# recently contributed repos
+	recentlyContributedTo: repositoriesContributedTo(first: 10) {
+		nodes {
+			...RepoDetails
 		}
+	}
 
-		hasSponsorsListing
-		totalSponsorshipAmountAsSponsorInCents
-		sponsors {
-			totalCount
+	# for stars calculations only considering top 100
+	repositories(
+		first: 100
+		ownerAffiliations: [OWNER, ORGANIZATION_MEMBER, COLLABORATOR]
+		orderBy: { direction: DESC, field: STARGAZERS }
+	) {
+		totalCount
+		nodes {
+			url
+			stargazerCount
 		}
-		sponsoring {
-			totalCount
-		}
-	} # user end
+	}
+
+	hasSponsorsListing
+	totalSponsorshipAmountAsSponsorInCents
+	sponsors {
+		totalCount
+	}
+	sponsoring {
+		totalCount
+	}
 }
 
 fragment RepoDetails on Repository {
@@ -265,3 +380,40 @@ fragment RepoDetails on Repository {
 	}
 }
 """
+
+RATE_LIMIT_FIELDS = """
+	rateLimit {
+		cost
+		limit
+		nodeCount
+		remaining
+		resetAt
+		used
+	}
+"""
+
+# Github Graphql Query used to obtained data
+GRAPHQL_QUERY = (
+    """
+query ($username: String!) {"""
+    + RATE_LIMIT_FIELDS
+    + """
+	user(login: $username) {
+		...UserDetails
+	}
+}
+"""
+    + USER_FRAGMENTS
+)
+
+
+# Builds the query fetching the users in one call, aliased as u0, u1, ...
+def build_batch_query(count: int):
+    variables = ", ".join(f"$u{i}: String!" for i in range(count))
+    users = "".join(
+        f"\n\tu{i}: user(login: $u{i}) {{\n\t\t...UserDetails\n\t}}\n"
+        for i in range(count)
+    )
+    return (
+        f"\nquery ({variables}) {{" + RATE_LIMIT_FIELDS + users + "}\n" + USER_FRAGMENTS
+    )
@@ -0,0 +1,221 @@
+import internal.cache as cache
+import internal.utils as utils
+import internal.cache_index as cache_index
+from internal.lru import LRUCache
+from internal.analyse_user import analyse_user, ANALYSIS_VIEWS
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import contextlib
+import hashlib
+import ipaddress
+import json
+import os
+import re
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+# analyses run in the background concurrently, per worker
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+
+# seconds after which a queued or running job, not updated since, is taken as
+# lost (like with its worker restarted) and submitting it again re-runs it
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", "600"))
+
+# hosts the callbacks may be posted to, comma separated, any public host if
+# empty. Hosts resolving to private, loopback or reserved addresses are
+# always refused, so the callbacks can't reach the internal network.
+JOB_CALLBACK_HOSTS = {
+    host.strip().lower()
+    for host in os.getenv("JOB_CALLBACK_HOSTS", "").split(",")
+    if host.strip()
+}
+
+# jobs kept in the worker's memory at most, when there is no MOUNT_DIRECTORY
+JOB_MEMORY_MAX_ENTRIES = int(os.getenv("JOB_MEMORY_MAX_ENTRIES", "1000"))
+JOB_MEMORY_MAX_BYTES = int(os.getenv("JOB_MEMORY_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Jobs are stored in the cache as jobs/{id}, shared by the workers, expiring
+# after CACHE_TTL_JOBS, or else in the worker's memory, expiring the same, the
+# least recently used ones evicted past JOB_MEMORY_MAX_*. A job is identified by
+# its (username, query), so submitting the same pair again returns the job
+# pending already.
+#   status: queued -> running -> done (with the analysis result) or failed
+
+# fields of the analysis result stored in the job, without the large ones
+JOB_RESULT_FIELDS = ANALYSIS_VIEWS["full"]
+
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{16}$")
+
+# the job json texts, decoded on every read, so the callers get their own copy
+_jobs = LRUCache(JOB_MEMORY_MAX_ENTRIES, JOB_MEMORY_MAX_BYTES, cache_index.ttl("jobs"))
+_update_lock = threading.Lock()
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+# Returns the thread pool running the jobs of this worker, created on first use
+def get_pool():
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(max_workers=JOB_WORKERS)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def job_id(username: str, query: str):
+    key = f"{username.lower()}\0{query}".encode("utf-8")
+    return hashlib.sha256(key).hexdigest()[:16]
+
+
+def job_key(id: str):
+    return f"jobs/{id}"
+
+
+# Reports whether the callback url is an http(s) url of an allowed, public host
+def valid_callback(url):
+    if not isinstance(url, str):
+        return False
+    try:
+        parsed = urlparse(url)
+        host = parsed.hostname
+        port = parsed.port
+    except ValueError:
+        return False
+    if parsed.scheme not in ("http", "https") or not host:
+        return False
+    if JOB_CALLBACK_HOSTS and host.lower() not in JOB_CALLBACK_HOSTS:
+        return False
+
+    try:
+        addresses = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        return False
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split("%", 1)[0])
+        if not address.is_global or address.is_multicast:
+            return False
+    return True
+
+
+# Locks the job's read-modify-write, against the threads and the other workers
+@contextlib.contextmanager
+def job_lock(id: str):
+    with _update_lock, cache.lock(f"jobs/{id}"):
+        yield
+
+
+# Returns the job, None if not found
+def read_job(id: str):
+    if not JOB_ID_PATTERN.match(id):
+        return None
+
+    if cache.MOUNT_DIRECTORY:
+        txt = cache.readBlob(job_key(id))
+    else:
+        txt = _jobs.get(id)
+    if txt is None:
+        return None
+    try:
+        return json.loads(txt)
+    except ValueError as e:
+        print(f"jobs: error reading {id}", e)
+        return None
+
+
+def save_job(job: dict):
+    job["updatedAt"] = time.time()
+    txt = json.dumps(job)
+    if not cache.MOUNT_DIRECTORY:
+        _jobs.set(job["id"], txt, len(txt))
+        return
+    # a blob, read from the disk every time, as the other workers update it
+    cache.writeBlob(job_key(job["id"]), txt)
+
+
+# Returns the job without its callbacks, to be served
+def public(job: dict):
+    return {k: v for k, v in job.items() if k != "callbacks"}
+
+
+def pending(job: dict):
+    return (
+        job["status"] in ("queued", "running")
+        and time.time() - job["updatedAt"] < JOB_STALE_AFTER
+    )
+
+
+# Applies the changes to the stored job, locked against the other workers
+def update_job(job: dict, **changes):
+    with job_lock(job["id"]):
+        job = read_job(job["id"]) or job
+        job.update(changes)
+        save_job(job)
+        return job
+
+
+# Submits the analysis of the user for the query, returns the job, the one
+# pending already for the same (username, query) when there is one
+def submit(username: str, query: str, nocache=False, callback=None):
+    id = job_id(username, query)
+    with job_lock(id):
+        job = read_job(id)
+        if job is not None and pending(job):
+            if callback and callback not in job["callbacks"]:
+                job["callbacks"].append(callback)
+                save_job(job)
+            return job
+
+        job = {
+            "id": id,
+            "status": "queued",
+            "username": username,
+            "query": query,
+            "nocache": nocache,
+            "callbacks": [callback] if callback else [],
+            "createdAt": time.time(),
+        }
+        save_job(job)
+
+    get_pool().submit(run, job)
+    return job
+
+
+def run(job: dict):
+    job = update_job(job, status="running")
+    try:
+        result = analyse_user(
+            job["username"],
+            job["query"],
+            job["nocache"],
+            JOB_RESULT_FIELDS,
+        )
+        job = update_job(job, status="done", result=result)
+    except Exception as err:
+        print(f"jobs: {job['id']} failed:", err)
+        job = update_job(job, status="failed", error="500: Internal Server Error")
+
+    for url in job["callbacks"]:
+        notify(url, job)
+
+
+# Posts the finished job to the callback url, once, without following the
+# redirects. The url is checked again, as its host may resolve differently now.
+def notify(url: str, job: dict):
+    if not valid_callback(url):
+        print(f"jobs: callback {url} refused for {job['id']}")
+        return
+    try:
+        requests.post(
+            url,
+            json=public(job),
+            timeout=utils.HTTP_TIMEOUT,
+            allow_redirects=False,
+        )
+    except requests.RequestException as e:
+        print(f"jobs: error calling back {url} for {job['id']}", e)
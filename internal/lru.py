@@ -0,0 +1,60 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+# LRUCache is an in-memory, thread safe, least recently used cache bounded by
+# the number of entries and their total (estimated) size in bytes.
+# Entries expire after ttl seconds, ttl <= 0 disables the expiry.
+# Cached values are shared between the callers, so treat them as read only.
+class LRUCache:
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()  # key -> (value, size, expiresAt)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, size, expiresAt = entry
+            if expiresAt and expiresAt < time.monotonic():
+                del self._entries[key]
+                self.size -= size
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, size: int):
+        if size > self.max_bytes or self.max_entries <= 0:
+            self.delete(key)
+            return
+
+        expiresAt = time.monotonic() + self.ttl if self.ttl > 0 else 0
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            self._entries[key] = (value, size, expiresAt)
+            self.size += size
+
+            # evict the least recently used entries
+            while self.size > self.max_bytes or len(self._entries) > self.max_entries:
+                _, (_, osize, _) = self._entries.popitem(last=False)
+                self.size -= osize
+
+    def delete(self, key: str):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,21 +1,58 @@
 import os
+import re
 import json
+import hashlib
 import openai
+import internal.cache as cache
 
 OPENAI_KEY = os.getenv("OPENAI_KEY")
 
+# chat model answering the questions
+OPENAI_MODEL = "gpt-3.5-turbo"
+
 systemPrompt = "You are very talented developer. You are provided some extracted details of all the files in a repository of a user (like what are the components or functions or comments, etc are there in them) in a particular format. Learn everything you can from the provided information. First the user will provide the details of the repository and then in the next message, a question will be provided for you to answer based on the provided information of the repository. \n > IMPORTANT NOTE: Always return a brief summary for the answer and if you are not able to find or deduce anything just respond with 'sorry, insufficient information!' \n"
 
 
-def generate_response(repoDetail: str, query: str):
+# Returns the normalized question, so the same question asked differently
+# (case, spacing, trailing punctuation) shares its cached answer
+def normalize_query(query: str):
+    return re.sub(r"\s+", " ", query).strip().rstrip("?.! ").lower()
+
+
+# Returns the cache key of the answer, a hash of everything the answer is
+# generated from
+def response_key(repoDetail: str, query: str):
+    key = json.dumps([repoDetail, normalize_query(query), OPENAI_MODEL, systemPrompt])
+    return "llm/" + hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+# Generates the answer to the query, cached for the same repo details and
+# question, "cached" tells whether it was served from the cache.
+# With on_token, the answer is streamed, on_token is called with its pieces
+# of text as they arrive (or the whole cached answer at once)
+def generate_response(repoDetail: str, query: str, nocache=False, on_token=None):
     if not OPENAI_KEY:
         return {
             "usage": {},
             "message": "error: OPENAI_KEY not provided",
         }
 
-    openai.api_key = OPENAI_KEY
-    messages = [
+    generated = []
+
+    def generate():
+        generated.append(True)
+        if on_token is not None:
+            return complete_streaming(repoDetail, query, on_token)
+        return complete(repoDetail, query)
+
+    resp = cache.fetchJSON(response_key(repoDetail, query), generate, nocache)
+    if on_token is not None and not generated:
+        on_token(resp["message"])
+    return dict(resp, cached=not generated)
+
+
+def build_messages(repoDetail: str, query: str):
+    return [
         {
             "role": "system",
             "content": systemPrompt,
@@ -27,10 +64,15 @@ def generate_response(repoDetail: str, query: str):
         },
         {"role": "user", "content": query},
     ]
+
+
+def complete(repoDetail: str, query: str):
+    openai.api_key = OPENAI_KEY
+    messages = build_messages(repoDetail, query)
     # print(json.dumps(messages))
 
     response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
+        model=OPENAI_MODEL,
         messages=messages,
     )
 
@@ -41,5 +83,29 @@ def generate_response(repoDetail: str, query: str):
 
     return {
         "message": "\n".join(resp),
-        "usage": response["usage"],
+        "usage": dict(response["usage"]),
+    }
+
+
+# Same as complete, streaming the answer's tokens to on_token as they arrive.
+# The streamed responses carry no usage.
+def complete_streaming(repoDetail: str, query: str, on_token):
+    openai.api_key = OPENAI_KEY
+    response = openai.ChatCompletion.create(
+        model=OPENAI_MODEL,
+        messages=build_messages(repoDetail, query),
+        stream=True,
+    )
+
+    resp = []
+    for chunk in response:
+        for cho in chunk["choices"]:
+            text = (cho.get("delta") or {}).get("content")
+            if text:
+                resp.append(text)
+                on_token(text)
+
+    return {
+        "message": "".join(resp).strip(),
+        "usage": {},
     }
@@ -1,6 +1,34 @@
 import re
 
 
+# whitespace within a line, and a js identifier
+_WS = r"[^\S\n]"
+_NAME = r"[a-zA-Z_$][\w$]*"
+
+# A single pattern scanning the whole content once. Comments and string
+# literals are matched first, so the declarations inside them are skipped.
+# The declarations capture what follows them too, as one declaration can fall
+# in multiple categories, like `export default const App = () =>`.
+TOKEN_PATTERN = re.compile(
+    rf"""
+    /\*(?P<block_comment>[\s\S]*?)\*/
+    | //(?P<line_comment>[^\r\n]*)
+    | '(?:[^'\\\n]|\\[\s\S])*'
+    | "(?:[^"\\\n]|\\[\s\S])*"
+    | `(?:[^`\\]|\\[\s\S])*`
+    | (?P<export>\bexport{_WS}+default{_WS}+(?:async{_WS}+)?)?
+      \b(?P<keyword>function|class|var|const|struct|type|interface){_WS}+
+      (?P<name>{_NAME})
+      (?P<call>{_WS}*\()?
+      (?P<assign>{_WS}*=(?P<arrow>{_WS}*\(\){_WS}*=>)?)?
+    | (?P<arrow_name>{_NAME}){_WS}*={_WS}*\(\){_WS}*=>
+    """,
+    re.VERBOSE,
+)
+
+_COMPONENT_START = re.compile(r"[A-Z_$]")
+
+
 def parse_js_file_content(fname: str, content: str):
     information = {
         "comments": [],
@@ -17,86 +45,69 @@ def parse_js_file_content(fname: str, content: str):
 
     is_jsx = fname.endswith((".tsx", ".jsx"))
 
-    lines = content.splitlines()
-    for line_number, line in enumerate(lines, start=1):
-        # Extract Comments
-        comments_match = re.findall(r"\/\/(.+)|\/\*(.+)\*\/", line)
-        if comments_match:
-            information["comments"].extend(
-                [
-                    {"name": c[0] if c[0] else c[1], "line_number": line_number}
-                    for c in comments_match
-                ]
+    line_number = 1
+    last = 0
+    for match in TOKEN_PATTERN.finditer(content):
+        if match.lastgroup is None:
+            # a string literal
+            continue
+
+        start = match.start()
+        line_number += content.count("\n", last, start)
+        last = start
+
+        keyword = match["keyword"]
+        if keyword is not None:
+            item = {"name": match["name"], "line_number": line_number}
+
+            # Extract Functions, Classes, Struct Types and Type Definitions
+            if keyword == "function":
+                if match["call"] is not None:
+                    information["functions"].append(item)
+            elif keyword == "class":
+                information["classes"].append(item)
+            elif keyword == "struct":
+                information["struct_types"].append(item)
+            elif keyword == "type" or keyword == "interface":
+                information["type_definitions"].append(item)
+
+            # Extract Global Variables and Constants, and Arrow Functions
+            elif match["assign"] is not None:
+                if keyword == "var":
+                    information["global_variables"].append(item)
+                else:
+                    information["constants"].append(item)
+                if match["arrow"] is not None:
+                    information["arrow_functions"].append(dict(item))
+
+            # Extract Components for TSX and JSX files
+            if (
+                is_jsx
+                and match["export"] is not None
+                and keyword in ("function", "const", "class")
+                and _COMPONENT_START.match(match["name"])
+            ):
+                information["components"].append(dict(item))
+            continue
+
+        if match["arrow_name"] is not None:
+            information["arrow_functions"].append(
+                {"name": match["arrow_name"], "line_number": line_number}
             )
+            continue
 
-        # Extract Functions
-        functions_match = re.findall(r"\bfunction\s+([a-zA-Z_$][\w$]*)\s*\(", line)
-        information["functions"].extend(
-            [{"name": func, "line_number": line_number} for func in functions_match]
-        )
-
-        # Extract Classes
-        classes_match = re.findall(r"\bclass\s+([a-zA-Z_$][\w$]*)", line)
-        information["classes"].extend(
-            [{"name": class_, "line_number": line_number} for class_ in classes_match]
-        )
-
-        # Extract Arrow Functions
-        arrow_functions_match = re.findall(r"([a-zA-Z_$][\w$]*)\s*=\s*\(\)\s*=>", line)
-        information["arrow_functions"].extend(
-            [
-                {"name": func, "line_number": line_number}
-                for func in arrow_functions_match
-            ]
-        )
-
-        # Extract Global Variables
-        global_variables_match = re.findall(r"\bvar\s+([a-zA-Z_$][\w$]*)\s*=", line)
-        information["global_variables"].extend(
-            [
-                {"name": var, "line_number": line_number}
-                for var in global_variables_match
-            ]
-        )
-
-        # Extract Struct Types (Assuming struct is defined similar to a class)
-        struct_types_match = re.findall(r"\bstruct\s+([a-zA-Z_$][\w$]*)", line)
-        information["struct_types"].extend(
-            [
-                {"name": struct, "line_number": line_number}
-                for struct in struct_types_match
-            ]
-        )
-
-        # Extract Constants
-        constants_match = re.findall(r"\bconst\s+([a-zA-Z_$][\w$]*)\s*=", line)
-        information["constants"].extend(
-            [{"name": const, "line_number": line_number} for const in constants_match]
-        )
-
-        # Extract Type Definitions
-        type_definitions_match = re.findall(
-            r"\b(?:type|interface)\s+([a-zA-Z_$][\w$]*)", line
-        )
-        information["type_definitions"].extend(
-            [
-                {"name": type_def, "line_number": line_number}
-                for type_def in type_definitions_match
-            ]
-        )
-
-        # Extract Components for TSX and JSX files
-        if is_jsx:
-            components_match = re.findall(
-                r"\b(?:export\s+default\s+(?:async\s+)?+(?:function|const|class)\s+([A-Z_$][\w$]*))",
-                line,
-            )
-
-            information["components"].extend(
-                [
-                    {"name": component, "line_number": line_number}
-                    for component in components_match
-                ]
+        # Extract Comments
+        comment = match["line_comment"]
+        if comment is None:
+            comment = match["block_comment"]
+            if comment is not None and "\n" in comment:
+                # multi-line comment, join its lines without the leading `*`
+                comment = " ".join(
+                    line.strip().lstrip("*").strip() for line in comment.splitlines()
+                ).strip()
+        if comment:
+            information["comments"].append(
+                {"name": comment, "line_number": line_number}
             )
 
     if is_jsx:
@@ -140,23 +151,21 @@ def parse_js_file_content(fname: str, content: str):
 
 
 def convert_to_plain_text(data):
-    result = []
-
-    for file_info in data:
-        file_name = file_info.get("path", "Unknown File")
-        result.append(f"{file_name} file contain:")
-
-        info = file_info.get("info", {})
-        for category, items in info.items():
-            if items:
-                names = ""
-                # result.append(f"{category}:")
-                for item in items:
-                    line_number = item.get("line_number", "")
-                    name = item.get("name", "")
-                    if name and line_number:
-                        names += f"{name} at line {line_number}, "
-                if names and len(names) > 1:
-                    result.append(f"  {category}: {names[:len(names)-2]}")
-
-    return "\n".join(result)
+    return "\n".join(line for file_info in data for line in render_file(file_info))
+
+
+# Yields the plain text lines describing a parsed file
+def render_file(file_info):
+    file_name = file_info.get("path", "Unknown File")
+    yield f"{file_name} file contain:"
+
+    info = file_info.get("info", {})
+    for category, items in info.items():
+        if items:
+            names = [
+                f"{item.get('name', '')} at line {item.get('line_number', '')}"
+                for item in items
+                if item.get("name", "") and item.get("line_number", "")
+            ]
+            if names:
+                yield f"  {category}: {', '.join(names)}"
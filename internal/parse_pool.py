@@ -0,0 +1,101 @@
+import os
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from internal.parse_js_file_content import parse_js_file_content
+
+# processes parsing the file contents, per worker, 0 parses everything inline
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "0"))
+
+# files smaller than this are parsed inline, as sending them to a process
+# costs more than parsing them
+PARSE_INLINE_MAX_BYTES = int(os.getenv("PARSE_INLINE_MAX_BYTES", "32768"))
+
+# files sent to a process together in one task
+PARSE_CHUNK_SIZE = int(os.getenv("PARSE_CHUNK_SIZE", "4"))
+
+
+# Reports whether gevent has patched the threads into greenlets (under the
+# gevent worker class), a process pool doesn't mix with its hub
+def cooperative():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+# Returns the process pool of this worker, created on first use
+def get_pool():
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # forkserver, as forking a threaded worker process isn't safe
+            _pool = ProcessPoolExecutor(
+                max_workers=PARSE_WORKERS,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def parse_many(files: list):
+    return [parse_js_file_content(fname, content) for fname, content in files]
+
+
+# Parses the (tag, fname, content, info) items, yielding (tag, info) in the
+# same order. Items already having an info are passed through.
+# Large files are parsed in the process pool, in chunks, while the items keep
+# being consumed, so the parsing overlaps with whatever produces the items.
+# Everything is parsed inline under gevent.
+def parse_in_order(items):
+    if PARSE_WORKERS <= 0 or cooperative():
+        for tag, fname, content, info in items:
+            if info is None:
+                info = parse_js_file_content(fname, content)
+            yield tag, info
+        return
+
+    pending = deque()  # [tag, info, future, index in chunk]
+    chunk = []
+
+    def flush():
+        future = get_pool().submit(parse_many, [(f, c) for _, f, c in chunk])
+        for i, (entry, _, _) in enumerate(chunk):
+            entry[2] = future
+            entry[3] = i
+        chunk.clear()
+
+    def ready(entry):
+        return entry[1] is not None or (entry[2] is not None and entry[2].done())
+
+    def result(entry):
+        if entry[1] is None:
+            entry[1] = entry[2].result()[entry[3]]
+        return entry[0], entry[1]
+
+    for tag, fname, content, info in items:
+        entry = [tag, info, None, 0]
+        if info is None:
+            if len(content) < PARSE_INLINE_MAX_BYTES:
+                entry[1] = parse_js_file_content(fname, content)
+            else:
+                chunk.append((entry, fname, content))
+                if len(chunk) >= PARSE_CHUNK_SIZE:
+                    flush()
+        pending.append(entry)
+
+        while pending and ready(pending[0]):
+            yield result(pending.popleft())
+
+    if chunk:
+        flush()
+    while pending:
+        yield result(pending.popleft())
@@ -0,0 +1,128 @@
+from internal.parse_js_file_content import render_file
+import math
+import os
+import re
+
+# estimated tokens of the repo details sent to the llm at most, the rest of
+# the context window is left for the system prompt, the question and answer
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+
+# bm25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# words of identifiers (camelCase, snake_case, ...) and numbers
+_WORD = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+")
+
+_SUFFIXES = ("ing", "ed", "es", "s")
+
+
+# Estimates the tokens of the text, ~4 characters per token for english and code
+def estimate_tokens(text: str):
+    return (len(text) + 3) // 4
+
+
+# Splits the text into lowercase, roughly stemmed words
+def words(text: str):
+    res = []
+    for word in _WORD.findall(text):
+        word = word.lower()
+        for suffix in _SUFFIXES:
+            if len(word) > len(suffix) + 3 and word.endswith(suffix):
+                word = word[: -len(suffix)]
+                break
+        res.append(word)
+    return res
+
+
+# Scores the documents (lists of words) against the query words, with bm25
+def bm25(docs: list, query: list):
+    if not docs:
+        return []
+
+    avg = sum(len(doc) for doc in docs) / len(docs) or 1
+    df = {}
+    for doc in docs:
+        for word in set(doc):
+            df[word] = df.get(word, 0) + 1
+
+    scores = []
+    for doc in docs:
+        tf = {}
+        for word in doc:
+            tf[word] = tf.get(word, 0) + 1
+
+        score = 0.0
+        for word in set(query):
+            if word not in tf:
+                continue
+            idf = math.log(1 + (len(docs) - df[word] + 0.5) / (df[word] + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * len(doc) / avg)
+            score += idf * tf[word] * (BM25_K1 + 1) / (tf[word] + norm)
+        scores.append(score)
+    return scores
+
+
+# Builds the repo details of the prompt, within the token budget. When the
+# whole plain text doesn't fit, every category line of every file is ranked by
+# its relevance to the query, and the best ones are kept, rendered in the
+# files' order, each under its file's header line.
+# Returns (details, report of the tokens used and dropped).
+def build_details(parsedFiles: list, query: str, plainText=None, budget=None):
+    if budget is None:
+        budget = PROMPT_TOKEN_BUDGET
+    if plainText is None:
+        plainText = "\n".join(
+            line for file_info in parsedFiles for line in render_file(file_info)
+        )
+
+    total = estimate_tokens(plainText)
+    if total <= budget:
+        return plainText, {
+            "budget": budget,
+            "tokensUsed": total,
+            "tokensDropped": 0,
+            "filesUsed": len(parsedFiles),
+            "filesDropped": 0,
+        }
+
+    headers = []
+    lines = []  # (file index, line)
+    for i, file_info in enumerate(parsedFiles):
+        rendered = render_file(file_info)
+        headers.append(next(rendered))
+        lines.extend((i, line) for line in rendered)
+
+    scores = bm25([words(line) for _, line in lines], words(query))
+    # the best scoring lines first, in the files' order on ties
+    ranked = sorted(range(len(lines)), key=lambda k: -scores[k])
+
+    used = 0
+    kept = set()
+    keptFiles = set()
+    for k in ranked:
+        i, line = lines[k]
+        cost = estimate_tokens(line) + 1
+        if i not in keptFiles:
+            cost += estimate_tokens(headers[i]) + 1
+        if used + cost > budget:
+            continue
+        used += cost
+        kept.add(k)
+        keptFiles.add(i)
+
+    details = []
+    for k, (i, line) in enumerate(lines):
+        if k not in kept:
+            continue
+        if not details or details[-1][0] != i:
+            details.append((i, headers[i]))
+        details.append((i, line))
+
+    return "\n".join(line for _, line in details), {
+        "budget": budget,
+        "tokensUsed": used,
+        "tokensDropped": max(total - used, 0),
+        "filesUsed": len(keptFiles),
+        "filesDropped": len(parsedFiles) - len(keptFiles),
+    }
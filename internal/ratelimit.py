@@ -0,0 +1,157 @@
+import os
+import time
+import hashlib
+import datetime
+import threading
+
+# points kept in reserve per token: interactive calls (high priority) are
+# refused below RATE_LIMIT_RESERVE, batch calls (low priority) below
+# RATE_LIMIT_BATCH_RESERVE, so batches never starve the interactive traffic
+RATE_LIMIT_RESERVE = int(os.getenv("RATE_LIMIT_RESERVE", "200"))
+RATE_LIMIT_BATCH_RESERVE = int(os.getenv("RATE_LIMIT_BATCH_RESERVE", "1000"))
+
+# seconds a low priority call may wait for the budget to reset, when refused
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "30"))
+
+_budgets = {}
+_lock = threading.Lock()
+
+
+# Returns a short fingerprint of the token, safe to expose and log
+def fingerprint(token: str):
+    if not token:
+        return "anonymous"
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:8]
+
+
+def _budget(token: str):
+    return _budgets.setdefault(
+        fingerprint(token),
+        {
+            "limit": None,
+            "remaining": None,
+            "used": None,
+            "resetAt": None,
+            "lastCost": None,
+            "updatedAt": None,
+        },
+    )
+
+
+# Records the rateLimit block of a graphql response
+def record(token: str, rateLimit: dict):
+    if not rateLimit:
+        return
+
+    resetAt = rateLimit.get("resetAt")
+    with _lock:
+        budget = _budget(token)
+        budget["limit"] = rateLimit.get("limit", budget["limit"])
+        budget["remaining"] = rateLimit.get("remaining", budget["remaining"])
+        budget["used"] = rateLimit.get("used", budget["used"])
+        budget["lastCost"] = rateLimit.get("cost", budget["lastCost"])
+        if resetAt:
+            budget["resetAt"] = datetime.datetime.fromisoformat(
+                resetAt.replace("Z", "+00:00")
+            ).timestamp()
+        budget["updatedAt"] = time.time()
+
+
+# Records the X-RateLimit-* headers, present on every response even the errors
+def record_headers(token: str, headers):
+    remaining = headers.get("X-RateLimit-Remaining")
+    if remaining is None:
+        return
+
+    with _lock:
+        budget = _budget(token)
+        budget["remaining"] = int(remaining)
+        if headers.get("X-RateLimit-Limit"):
+            budget["limit"] = int(headers["X-RateLimit-Limit"])
+        if headers.get("X-RateLimit-Used"):
+            budget["used"] = int(headers["X-RateLimit-Used"])
+        if headers.get("X-RateLimit-Reset"):
+            budget["resetAt"] = float(headers["X-RateLimit-Reset"])
+        budget["updatedAt"] = time.time()
+
+
+# Marks the token exhausted until its reset time
+def exhausted(token: str, resetAt=None):
+    with _lock:
+        budget = _budget(token)
+        budget["remaining"] = 0
+        if resetAt:
+            budget["resetAt"] = float(resetAt)
+        budget["updatedAt"] = time.time()
+
+
+# Returns the points left for the token, None if unknown yet
+def remaining(token: str):
+    with _lock:
+        budget = _budgets.get(fingerprint(token))
+        if budget is None or budget["remaining"] is None:
+            return None
+        if budget["resetAt"] and budget["resetAt"] <= time.time():
+            # the budget has been reset since the last response
+            return budget["limit"]
+        return budget["remaining"]
+
+
+# Returns the unix time at which the token's budget resets, None if unknown
+def reset_at(token: str):
+    with _lock:
+        budget = _budgets.get(fingerprint(token))
+        return budget["resetAt"] if budget else None
+
+
+# Returns the token with the most budget left, that a call of the priority
+# ("high" or "low") may spend, None when all of them are at their reserve.
+# Tokens without any known budget yet are preferred, to learn about them.
+# Low priority calls wait for the earliest reset when it is near.
+def pick(tokens: list, priority="high"):
+    reserve = RATE_LIMIT_RESERVE if priority == "high" else RATE_LIMIT_BATCH_RESERVE
+
+    best, bestLeft = None, -1
+    for token in tokens:
+        left = remaining(token)
+        if left is None:
+            left = float("inf")
+        if left >= reserve and left > bestLeft:
+            best, bestLeft = token, left
+
+    if best is not None or priority == "high":
+        return best
+
+    resetAt = earliest_reset(tokens)
+    if resetAt:
+        wait = resetAt - time.time()
+        if 0 < wait <= RATE_LIMIT_MAX_WAIT:
+            time.sleep(wait)
+            return min(tokens, key=lambda t: reset_at(t) or float("inf"))
+
+    return None
+
+
+# Returns the earliest unix time at which one of the tokens resets
+def earliest_reset(tokens: list):
+    resets = [reset_at(token) for token in tokens]
+    resets = [r for r in resets if r]
+    return min(resets) if resets else None
+
+
+def format_reset(resetAt):
+    if not resetAt:
+        return "some time"
+    reset_time = datetime.datetime.fromtimestamp(float(resetAt), datetime.timezone.utc)
+    return reset_time.strftime("%Y-%m-%d %H:%M:%S UTC")
+
+
+# Returns the budgets of all the tokens used by this worker
+def snapshot():
+    with _lock:
+        res = {}
+        for fp, budget in _budgets.items():
+            res[fp] = dict(budget)
+            if budget["resetAt"]:
+                res[fp]["resetAt"] = format_reset(budget["resetAt"])
+        return res
@@ -0,0 +1,171 @@
+from internal.prompt import words
+import os
+
+# answer the structured questions (counts, listings, documentation ratios)
+# from the index, without calling the llm
+INDEX_FAST_PATH = os.getenv("INDEX_FAST_PATH", "1") not in ("", "0", "false")
+
+# symbols listed in an answer at most
+INDEX_MAX_LISTED = int(os.getenv("INDEX_MAX_LISTED", "50"))
+
+# query words naming a category, as stemmed by prompt.words, the first match
+# in this order wins, like "arrow" over "function"
+CATEGORY_WORDS = [
+    ("arrow", "arrow_functions"),
+    ("global", "global_variables"),
+    ("variable", "global_variables"),
+    ("component", "components"),
+    ("hook", "hooks"),
+    ("class", "classes"),
+    ("function", "functions"),
+    ("constant", "constants"),
+    ("struct", "struct_types"),
+    ("type", "type_definitions"),
+    ("interface", "type_definitions"),
+    ("comment", "comments"),
+]
+
+# the query words asking for a count, a listing, a quantity, the documentation.
+# "what" isn't a listing, as in "what does it do", it's left to the other words
+COUNT_WORDS = set(words("many count number"))
+LIST_WORDS = set(words("which list name show where"))
+QUANTITY_WORDS = set(words("much many ratio percent percentage fraction per"))
+DOC_WORDS = set(words("documented documentation comments"))
+
+# words carrying no meaning for the index lookups
+STOP_WORDS = set(
+    words(
+        "how what is are the a an of in there s use uses used repo repository"
+        " code codebase project react all defined declared have has file files"
+        " by for with and or this it its total at line to"
+    )
+)
+
+# query words asking about the behaviour or the purpose of the code, which the
+# index knows nothing about, like "what does the user function do", and the
+# words before "of" making the category word a plain noun, like "type of app"
+OPEN_WORDS = set(
+    words(
+        "do does did doing done why purpose purposes explain describe describes"
+        " work works mean means meaning handle handles happen happens"
+    )
+)
+OPEN_BEFORE_OF = set(words("type kind sort"))
+
+
+# Builds the inverted index of the parsed files: the symbols per category,
+# and the (category, symbol position) postings per word of the symbols' names
+# and comments' text
+def build_index(parsedFiles: list):
+    categories = {}
+    terms = {}
+    for file_info in parsedFiles:
+        for category, items in (file_info.get("info") or {}).items():
+            symbols = categories.setdefault(category, [])
+            for item in items:
+                symbol = {
+                    "name": item.get("name", ""),
+                    "path": file_info.get("path", ""),
+                    "line_number": item.get("line_number"),
+                }
+                for word in set(words(symbol["name"])):
+                    terms.setdefault(word, []).append((category, len(symbols)))
+                symbols.append(symbol)
+
+    return {"files": len(parsedFiles), "categories": categories, "terms": terms}
+
+
+# Returns the category named by the query words, None if none
+def query_category(query: list):
+    for word, category in CATEGORY_WORDS:
+        if word in query:
+            return category
+    return None
+
+
+# Answers the query from the index, when it asks for a count, a listing or
+# a documentation ratio, in the format of openapi.generate_response.
+# Returns None for the open-ended questions, left to the llm, like when the
+# query has words the index knows nothing about.
+def answer(index: dict, query: str):
+    query = words(query)
+    if OPEN_WORDS & set(query) or any(
+        w in OPEN_BEFORE_OF and n == "of" for w, n in zip(query, query[1:])
+    ):
+        return None
+    category = query_category(query)
+
+    known = STOP_WORDS | COUNT_WORDS | LIST_WORDS | QUANTITY_WORDS | DOC_WORDS
+    known |= {word for word, _ in CATEGORY_WORDS}
+    rest = [w for w in query if w not in known]
+    if any(w not in index["terms"] for w in rest):
+        return None
+
+    if DOC_WORDS & set(query) and QUANTITY_WORDS & set(query) and not rest:
+        return documentation(index)
+    if category is None:
+        return None
+
+    symbols = index["categories"].get(category, [])
+    if rest:
+        # only the symbols having the words in their names
+        matched = set()
+        for w in rest:
+            matched.update(i for c, i in index["terms"][w] if c == category)
+        symbols = [symbols[i] for i in sorted(matched)]
+
+    if COUNT_WORDS & set(query):
+        files = len({symbol["path"] for symbol in symbols})
+        return {
+            "message": f"Found {len(symbols)} {category.replace('_', ' ')} across "
+            + f"{files} of the {index['files']} analysed files.",
+            "usage": {},
+            "answer": {"category": category, "count": len(symbols), "files": files},
+        }
+    if LIST_WORDS & set(query):
+        listed = symbols[:INDEX_MAX_LISTED]
+        message = f"{category.replace('_', ' ')}: " + (
+            ", ".join(f"{s['name']} ({s['path']}:{s['line_number']})" for s in listed)
+            or "none found"
+        )
+        if len(symbols) > len(listed):
+            message += f" and {len(symbols) - len(listed)} more"
+        return {
+            "message": message,
+            "usage": {},
+            "answer": {"category": category, "count": len(symbols), "items": listed},
+        }
+    return None
+
+
+# Answers how much of the code is documented: comments per declaration, and
+# the files having comments
+def documentation(index: dict):
+    categories = index["categories"]
+    comments = categories.get("comments", [])
+    declarations = sum(
+        len(categories.get(c, []))
+        for c in ("functions", "classes", "arrow_functions", "type_definitions")
+    )
+    commented = len({symbol["path"] for symbol in comments})
+    files = index["files"]
+
+    perDeclaration = round(len(comments) / declarations, 2) if declarations else 0
+    filesRatio = round(commented / files, 2) if files else 0
+    return {
+        "message": (
+            f"{commented} of the {files} analysed files ({round(filesRatio * 100)}%)"
+            f" have comments, with {len(comments)} comments for {declarations}"
+            f" functions, classes and types, {perDeclaration} comments per"
+            " declaration."
+        ),
+        "usage": {},
+        "answer": {
+            "comments": len(comments),
+            "declarations": declarations,
+            "commentsPerDeclaration": perDeclaration,
+            "filesWithComments": commented,
+            "files": files,
+            "filesWithCommentsRatio": filesRatio,
+        },
+    }
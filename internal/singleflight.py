@@ -0,0 +1,57 @@
+import os
+import threading
+
+# seconds a follower waits on the leader's result, before doing the work itself
+SINGLEFLIGHT_TIMEOUT = float(os.getenv("SINGLEFLIGHT_TIMEOUT", "30"))
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Group coalesces concurrent calls for the same key within the process: the
+# first caller (leader) runs the function, the others (followers) block on the
+# leader's result, or its exception, instead of running it again.
+# The work across processes is coalesced by the cache locks (cache.fetchJSON).
+class Group:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn, timeout=SINGLEFLIGHT_TIMEOUT):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            if not call.done.wait(timeout):
+                # the leader is taking too long, don't keep the caller hanging
+                return fn()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+_group = Group()
+
+
+# Runs fn for the key, shared with the concurrent callers of the same key
+def do(key: str, fn, timeout=SINGLEFLIGHT_TIMEOUT):
+    return _group.do(key, fn, timeout)
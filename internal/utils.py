@@ -1,10 +1,14 @@
 import requests
-import datetime
+import internal.cache as cache
+import internal.ratelimit as ratelimit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import hashlib
 import os
-import json
-
-# MOUNT_DIRECTORY
-MOUNT_DIRECTORY = os.getenv("MOUNT_DIRECTORY")
+import threading
+from urllib.parse import urlparse
 
 # GitHub GraphQL API endpoint
 GITHUB_GRAPHQL_API_ENDPOINT = "https://api.github.com/graphql"
@@ -12,12 +16,95 @@ GITHUB_GRAPHQL_API_ENDPOINT = "https://api.github.com/graphql"
 # GitHub personal access token for authentication
 GITHUB_ACCESS_TOKEN = os.getenv("GITHUB_ACCESS_TOKEN")
 
+# Pool of more tokens, comma separated or one per line in a file, every call
+# uses the token having the most rate limit budget left
+GITHUB_ACCESS_TOKENS = os.getenv("GITHUB_ACCESS_TOKENS", "")
+GITHUB_ACCESS_TOKENS_FILE = os.getenv("GITHUB_ACCESS_TOKENS_FILE")
+
+# maximum concurrent requests made to a single host (per worker)
+HOST_CONCURRENCY = int(os.getenv("HOST_CONCURRENCY", "8"))
+
+# http connection pool size per host, and request timeout in seconds
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15"))
+
+# retries on connection errors and 5xx responses, with exponential backoff
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.3"))
+
+
+# Returns all the configured access tokens, without duplicates
+def load_tokens():
+    tokens = [GITHUB_ACCESS_TOKEN] + GITHUB_ACCESS_TOKENS.split(",")
+    if GITHUB_ACCESS_TOKENS_FILE:
+        with open(GITHUB_ACCESS_TOKENS_FILE) as f:
+            tokens += [
+                line for line in f.read().splitlines() if not line.startswith("#")
+            ]
+
+    tokens = [token.strip() for token in tokens if token and token.strip()]
+    # without any token, the calls are made anonymously (and fail)
+    return list(dict.fromkeys(tokens)) or [""]
+
+
+TOKEN_POOL = load_tokens()
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+
+# Returns the semaphore limiting the concurrent requests to the url's host
+def host_slot(url: str):
+    host = urlparse(url).netloc
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(HOST_CONCURRENCY)
+        return _host_slots[host]
+
+
+# Returns the http session shared by the worker process, it keeps the
+# connections to github alive across the requests.
+# The session is re-created after a fork, as sockets can't be shared.
+def get_session():
+    global _session, _session_pid
+
+    pid = os.getpid()
+    if _session is not None and _session_pid == pid:
+        return _session
+
+    with _session_lock:
+        if _session is None or _session_pid != pid:
+            retry = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=HTTP_BACKOFF,
+                status_forcelist=[500, 502, 503, 504],
+                # graphql queries are read only, so safe to retry the POST too
+                allowed_methods=["GET", "POST"],
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=HTTP_POOL_SIZE,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+            _session_pid = pid
+
+    return _session
+
 
 # Handles rate limiting
-def handle_rate_limiting(response: requests.Response):
-    reset_time = int(response.headers["X-RateLimit-Reset"])
-    reset_time = datetime.utcfromtimestamp(reset_time)
-    reset_time = reset_time.strftime("%Y-%m-%d %H:%M:%S UTC")
+def handle_rate_limiting(response: requests.Response, token=None):
+    reset_time = response.headers.get("X-RateLimit-Reset")
+    ratelimit.exhausted(token, reset_time)
+    reset_time = ratelimit.format_reset(reset_time or ratelimit.reset_at(token))
 
     return {
         "statusCode": 429,
@@ -25,22 +112,48 @@ def handle_rate_limiting(response: requests.Response):
     }
 
 
-# Make api request
-def fetch_github_query(query: str, variables: dict):
+# Make api request, with partial=True the body is returned along with its
+# errors when some data is present, like for the aliased batch queries.
+# The call is made with the token having the most budget left, failing over
+# to the next one when rate limited. Calls are refused before the budgets run
+# out, see ratelimit.pick, low priority ones (like batches) earlier.
+def fetch_github_query(query: str, variables: dict, partial=False, priority="high"):
+    candidates = list(TOKEN_POOL)
+    while True:
+        token = ratelimit.pick(candidates, priority)
+        if token is None:
+            reset_time = ratelimit.format_reset(ratelimit.earliest_reset(TOKEN_POOL))
+            return {
+                "statusCode": 429,
+                "error": f"Too many requests. Rate limit budget reserved. Try again after {reset_time}",
+            }
+
+        resp = fetch_github_query_with_token(token, query, variables, partial)
+        if resp.get("statusCode") == 429 and len(candidates) > 1:
+            candidates.remove(token)
+            continue
+        return resp
+
+
+def fetch_github_query_with_token(
+    token: str, query: str, variables: dict, partial=False
+):
     headers = {
-        "Authorization": f"Bearer {GITHUB_ACCESS_TOKEN}",
+        "Authorization": f"Bearer {token}",
         "Content-Type": "application/json",
     }
 
-    resp = requests.post(
+    resp = get_session().post(
         GITHUB_GRAPHQL_API_ENDPOINT,
         headers=headers,
         json={"query": query, "variables": variables},
+        timeout=HTTP_TIMEOUT,
     )
+    ratelimit.record_headers(token, resp.headers)
 
     # rate limit reached, github returns 403 for rate limiting
     if resp.status_code == 403:
-        return handle_rate_limiting(resp)
+        return handle_rate_limiting(resp, token)
 
     if resp.status_code != 200:
         return {
@@ -56,13 +169,22 @@ def fetch_github_query(query: str, variables: dict):
             "error": "500 - Something went wrong",
         }
 
+    if body.get("data"):
+        ratelimit.record(token, body["data"].get("rateLimit"))
+
     # handle errors in body
     if "errors" in body:
         # check for gql rate limiting
         for error in body["errors"]:
-            et = error["type"]
+            et = error.get("type")
             if et == "RATE_LIMITED":
-                return handle_rate_limiting(resp)
+                return handle_rate_limiting(resp, token)
+
+        if partial and body.get("data") is not None:
+            return body
+
+        for error in body["errors"]:
+            et = error.get("type")
             if et == "NOT_FOUND":
                 pt = error["path"]
                 if pt is not None and len(pt) > 0:
@@ -82,70 +204,80 @@ def fetch_github_query(query: str, variables: dict):
     return body
 
 
+# Returns the git blob sha of the text, as git hashes its utf-8 bytes
+def blob_oid(text: str):
+    data = text.encode("utf-8")
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+# Returns the cache key of the file content, its git blob sha (oid) when known
+def content_key(owner: str, repo: str, path: str, branch="HEAD", oid=None):
+    if oid:
+        return f"blobs/{oid}"
+    return f"files/{owner}/{repo}/{branch}/{path.lstrip('/')}"
+
+
+# Maps fn over the items concurrently, while yielding the results in the same
+# order. At most workers calls are in flight at any time, so the items after
+# the ones we stop consuming at are never started.
+def ordered_map(fn, items, workers: int):
+    pending = deque()
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) < workers:
+                continue
+
+            yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # consumer stopped early, drop the calls not started yet
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+
+# Downloads the file content, cached by its git blob sha (oid) when known.
+# The file is downloaded from the branch, which may have moved on since the oid
+# was read from the tree, so the content is only cached under the oid when it
+# hashes to it.
 def download_github_file(
     owner: str,
     repo: str,
     path: str,
     branch="HEAD",
     nocache=False,
+    oid=None,
 ):
     if path.startswith("/"):
         path = path[1:]
 
-    ckey = f"files/{owner}/{repo}/{branch}/{path}"
-    cval = readData(ckey, nocache)
-    if cval is not None:
-        return cval
-
-    # GitHub raw content URL
-    url = f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{path}"
-
-    try:
-        resp = requests.get(url)
-        if resp.status_code == 200:
-            # Return the content
-            data = resp.text
-            writeData(ckey, data)
-            return data
-
-        print(f"Error downloading file {owner}/{repo}/{path}: {resp.status_code}")
-        return None
-    except Exception as e:
-        print(f"Error downloading file {owner}/{repo}/{path}", e)
-        return None
-
-
-def readData(fname: str, nocache=False):
-    if nocache:
-        return None
-    try:
-        f = open(MOUNT_DIRECTORY + "/" + fname, "r")
-        data = f.read()
-        data = json.loads(data)
-        return data
-    except:
-        return None
-
-
-def writeData(fname: str, txt: str):
-    filepath = MOUNT_DIRECTORY + "/" + fname
-    dirpath = os.path.dirname(filepath)
-
-    if dirpath and not os.path.exists(dirpath):
-        os.makedirs(dirpath)
+    ckey = content_key(owner, repo, path, branch, oid)
 
-    f = open(filepath, "w+")
-    f.write(txt)
-    f.close()
+    def download():
+        # GitHub raw content URL
+        url = f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{path}"
 
+        try:
+            with host_slot(url):
+                resp = get_session().get(url, timeout=HTTP_TIMEOUT)
+            if resp.status_code == 200:
+                # Return the content
+                return resp.text
 
-def appendData(fname: str, txt: str):
-    filepath = MOUNT_DIRECTORY + "/" + fname
-    dirpath = os.path.dirname(filepath)
+            print(f"Error downloading file {owner}/{repo}/{path}: {resp.status_code}")
+            return None
+        except Exception as e:
+            print(f"Error downloading file {owner}/{repo}/{path}", e)
+            return None
 
-    if dirpath and not os.path.exists(dirpath):
-        os.makedirs(dirpath)
+    def matches(text):
+        if oid and blob_oid(text) != oid:
+            print(f"File {owner}/{repo}/{path} changed since {oid}, not cached")
+            return False
+        return True
 
-    f = open(filepath, "a")
-    f.write(txt)
-    f.close()
+    return cache.fetchBlob(ckey, download, nocache, cacheable=matches)
@@ -3,10 +3,19 @@ from dotenv import load_dotenv
 # load envs from .env file
 load_dotenv()
 
-from flask import Flask, request
-import internal.utils as utils
-from internal.fetch_stats import fetch_user_data
-from internal.analyse_user import analyse_user
+from flask import Flask, Response, request, stream_with_context
+import internal.cache as cache
+import internal.ratelimit as ratelimit
+from internal.fetch_stats import (
+    fetch_user_data,
+    fetch_users_data,
+    project_user_response,
+    BATCH_MAX_USERS,
+    USER_VIEWS,
+)
+from internal.analyse_user import analyse_user, stream_analysis, ANALYSIS_VIEWS
+import internal.jobs as jobs
+import json
 import os
 
 
@@ -34,6 +43,40 @@ def internal_error(e):
     return {"status_code": 500, "error": "500 - something went wrong"}, 500
 
 
+# Returns the response fields asked by the view= or the fields= (comma
+# separated) query params, None for all of them, along with the error response
+def requested_fields(views: dict):
+    allFields = set().union(*views.values())
+
+    fields = request.args.get("fields")
+    if fields:
+        fields = {field.strip() for field in fields.split(",") if field.strip()}
+        unknown = fields - allFields
+        if unknown:
+            return None, (
+                {
+                    "statusCode": 400,
+                    "error": f"unknown fields: {', '.join(sorted(unknown))}",
+                },
+                400,
+            )
+        return fields, None
+
+    view = request.args.get("view")
+    if view:
+        if view not in views:
+            return None, (
+                {
+                    "statusCode": 400,
+                    "error": f"view must be one of: {', '.join(views)}",
+                },
+                400,
+            )
+        return views[view], None
+
+    return None, None
+
+
 @app.route("/")
 def home_route():
     return {
@@ -66,7 +109,11 @@ def fetch_github_user_data_route():
                 "error": "Username not provided in the request body",
             }, 400
 
-        resp = fetch_user_data(username, nocache)
+        fields, error = requested_fields(USER_VIEWS)
+        if error is not None:
+            return error
+
+        resp = project_user_response(fetch_user_data(username, nocache), fields)
         return resp, resp["statusCode"], {"Cache-Control": "public"}
 
     except Exception as err:
@@ -77,12 +124,68 @@ def fetch_github_user_data_route():
         }, 500
 
 
+@app.route("/fetch/batch", methods=["POST"])
+def fetch_github_users_data_route():
+    try:
+        body = request.get_json(silent=True) or {}
+        usernames = body.get("usernames")
+        nocache = bool(body.get("nocache"))
+
+        # Check if the usernames are provided
+        if (
+            not isinstance(usernames, list)
+            or len(usernames) == 0
+            or not all(isinstance(u, str) and u.strip() for u in usernames)
+        ):
+            return {
+                "statusCode": 400,
+                "error": "usernames list not provided in the request body",
+            }, 400
+
+        if len(usernames) > BATCH_MAX_USERS:
+            return {
+                "statusCode": 400,
+                "error": f"at most {BATCH_MAX_USERS} usernames are allowed",
+            }, 400
+
+        resp = fetch_users_data(usernames, nocache)
+        return {
+            "statusCode": 200,
+            "data": resp,
+        }, 200
+
+    except Exception as err:
+        print("exception something went wrong in batch fetch:", err)
+        return {
+            "statusCode": 500,
+            "error": "500: Internal Server Error",
+        }, 500
+
+
 @app.route("/check")
 def check_volume():
-    dir = utils.MOUNT_DIRECTORY
+    dir = cache.MOUNT_DIRECTORY
     res = os.listdir(dir)
     return {
         "list": res,
+        "cache": cache.stats(),
+    }, 200
+
+
+@app.route("/ratelimit")
+def rate_limit_route():
+    return {
+        "statusCode": 200,
+        "tokens": ratelimit.snapshot(),
+    }, 200
+
+
+@app.route("/cache/sweep", methods=["POST"])
+def sweep_cache():
+    removed = cache.sweep()
+    return {
+        "statusCode": 200,
+        "removed": removed,
     }, 200
 
 
@@ -97,8 +200,12 @@ def analyse_username(username: str):
         if request.args.get("nocache"):
             nocache = True
 
+        fields, error = requested_fields(ANALYSIS_VIEWS)
+        if error is not None:
+            return error
+
         # analyze user
-        resp = analyse_user(username, query, nocache)
+        resp = analyse_user(username, query, nocache, fields)
         return resp, resp["statusCode"], {"Cache-Control": "public"}
 
     except Exception as err:
@@ -107,3 +214,84 @@ def analyse_username(username: str):
             "statusCode": 500,
             "error": "500: Internal Server Error",
         }, 500
+
+
+# Streams the analysis as server-sent events: its progress, then the answer's
+# tokens as they are generated, and finally the result (done) or the error
+@app.route("/analyse/<username>/stream")
+def analyse_username_stream(username: str):
+    query = request.args.get("query")
+    if query is None:
+        query = "How well has the user documented the codebase?"
+
+    nocache = False
+    if request.args.get("nocache"):
+        nocache = True
+
+    def events():
+        for event, data in stream_analysis(username, query, nocache):
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        # disable the buffering of the proxies, to deliver the events right away
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/jobs", methods=["POST"])
+def submit_job_route():
+    try:
+        body = request.get_json(silent=True) or {}
+        username = body.get("username")
+        query = body.get("query")
+        if query is None:
+            query = "How well has the user documented the codebase?"
+        nocache = bool(body.get("nocache"))
+        callback = body.get("callback")
+
+        # Check if the username is provided
+        if not isinstance(username, str) or not username.strip():
+            return {
+                "statusCode": 400,
+                "error": "Username not provided in the request body",
+            }, 400
+
+        if callback is not None and not jobs.valid_callback(callback):
+            return {
+                "statusCode": 400,
+                "error": "callback must be an http(s) url of a public host",
+            }, 400
+
+        job = jobs.submit(username.strip(), str(query), nocache, callback)
+        return (
+            {
+                "statusCode": 202,
+                "job": jobs.public(job),
+            },
+            202,
+            {"Location": f"/jobs/{job['id']}"},
+        )
+
+    except Exception as err:
+        print("exception something went wrong in job submit:", err)
+        return {
+            "statusCode": 500,
+            "error": "500: Internal Server Error",
+        }, 500
+
+
+@app.route("/jobs/<id>")
+def job_route(id: str):
+    job = jobs.read_job(id)
+    if job is None:
+        return {
+            "statusCode": 404,
+            "error": "job not found",
+        }, 404
+
+    return {
+        "statusCode": 200,
+        "job": jobs.public(job),
+    }, 200